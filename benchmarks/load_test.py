@@ -0,0 +1,234 @@
+"""
+End to end load test for the ZeroMQ pipeline.  Starts the server and workers locally, drives
+them with concurrent clients and reports throughput and latency percentiles.
+
+    python benchmarks/load_test.py --workers 4 --clients 8 --requests 200 --tasks-per-request 50
+    python benchmarks/load_test.py --replay recorded_requests.jsonl --output results.json
+
+Replay files have one request message per line, e.g.
+{"message type": "request", "tasks": [{"task_id": "1", "task": "pay rent"}]}
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import zmq
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from wire_format import JSON, encode, decode  # noqa: E402
+
+# words put in front of starter keywords to make synthetic tasks
+TASK_PREFIXES = ["", "go to", "finish", "schedule", "buy", "clean the", "call about", "review"]
+
+
+def synthetic_requests(num_requests: int, tasks_per_request: int, seed=361) -> list:
+    """
+    Builds request messages from the starter keyword vocabulary.
+    :param num_requests: number of requests to build
+    :param tasks_per_request: tasks in each request
+    :param seed: random seed so runs are comparable
+    :return: list of request dictionaries
+    """
+    with open(os.path.join(REPO_DIR, "starter_tasks.json"), "r") as file:
+        keywords = [keyword for keywords in json.load(file).values() for keyword in keywords]
+
+    rng = random.Random(seed)
+    requests = []
+    for request_no in range(num_requests):
+        tasks = []
+        for task_no in range(tasks_per_request):
+            task = f"{rng.choice(TASK_PREFIXES)} {rng.choice(keywords)}".strip()
+            tasks.append({"task_id": str(task_no), "task": task.capitalize()})
+        requests.append({"message type": "request", "tasks": tasks})
+    return requests
+
+
+def replay_requests(file_name: str) -> list:
+    """Reads request messages from a JSONL file, one request per line"""
+    requests = []
+    with open(file_name, "r") as file:
+        for line in file:
+            if line.strip():
+                message = json.loads(line)
+                if "tasks" in message:
+                    message["message type"] = "request"
+                    requests.append(message)
+    return requests
+
+
+class LoadClient(threading.Thread):
+    """Represents a client thread that sends its share of the requests one at a time"""
+    def __init__(self, context, address: str, socket_type: str, requests: list, timeout: float, encoding=JSON):
+        super().__init__(daemon=True)
+        self._socket = context.socket(zmq.REQ if socket_type == "req" else zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+        self._socket.connect(address)
+        self._socket_type = socket_type
+        self._requests = requests
+        self._encoding = encoding
+
+        self.latencies = []
+        self.tasks = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def send_request(self, request: dict) -> dict:
+        """Sends a request and waits for its response"""
+        payload = encode(dict(request, encoding=self._encoding), self._encoding)
+        if self._socket_type == "req":
+            self._socket.send(payload)
+            return decode(self._socket.recv())
+        # a DEALER client adds the empty delimiter frame that REQ adds for us
+        self._socket.send_multipart([b"", payload])
+        return decode(self._socket.recv_multipart()[-1])
+
+    def run(self):
+        for request in self._requests:
+            start = time.perf_counter()
+            try:
+                response = self.send_request(request)
+            except zmq.Again:
+                self.errors += 1
+                break
+            if response.get("message type") == "busy":
+                self.rejected += 1
+                continue
+            self.latencies.append(time.perf_counter() - start)
+            self.tasks += len(response.get("tasks", []))
+        self._socket.close()
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Returns the nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def start_pipeline(port: int, workers: int, chunk_size: int, worker_args: list) -> list:
+    """Starts the server and worker processes and returns them"""
+    processes = [subprocess.Popen([sys.executable, "zeromq_server.py", "--port", str(port),
+                                   "--chunk-size", str(chunk_size)],
+                                  cwd=REPO_DIR, stdout=subprocess.DEVNULL)]
+    for _ in range(workers):
+        processes.append(subprocess.Popen([sys.executable, "category_worker.py", "--port", str(port + 1)]
+                                          + worker_args, cwd=REPO_DIR, stdout=subprocess.DEVNULL))
+    return processes
+
+
+def wait_until_ready(context, address: str, timeout: float):
+    """Sends warm-up requests until the pipeline answers"""
+    deadline = time.monotonic() + timeout
+    warm_up = {"message type": "request", "tasks": [{"task_id": "0", "task": "warm up"}]}
+    while time.monotonic() < deadline:
+        client = LoadClient(context, address, "req", [warm_up], timeout=1.0)
+        client.run()
+        if client.latencies:
+            return
+    raise RuntimeError("pipeline did not answer before the startup timeout")
+
+
+def run_load_test(args) -> dict:
+    """Runs the configured load test and returns its results"""
+    if args.replay:
+        requests = replay_requests(args.replay)
+    else:
+        requests = synthetic_requests(args.requests, args.tasks_per_request)
+
+    processes = []
+    if not args.external:
+        processes = start_pipeline(args.port, args.workers, args.chunk_size, args.worker_args)
+
+    context = zmq.Context()
+    address = f"tcp://{args.host}:{args.port}"
+    try:
+        wait_until_ready(context, address, args.startup_timeout)
+
+        # deals the requests out to the clients round-robin
+        clients = [LoadClient(context, address, args.socket, requests[client_no::args.clients], args.timeout,
+                              args.encoding)
+                   for client_no in range(args.clients)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        context.term()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    tasks = sum(client.tasks for client in clients)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "commit": git_commit(),
+        "requests": len(latencies),
+        "tasks": tasks,
+        "errors": sum(client.errors for client in clients),
+        "rejected": sum(client.rejected for client in clients),
+        "elapsed_s": elapsed,
+        "requests_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "tasks_per_s": tasks / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": (latencies[-1] if latencies else 0.0) * 1000
+        }
+    }
+
+
+def git_commit():
+    """Returns the current commit so saved results can be compared between commits"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the task categorizer pipeline")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=18888, help="server port, workers use port + 1")
+    parser.add_argument("--external", action="store_true",
+                        help="test an already running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--chunk-size", type=int, default=50)
+    parser.add_argument("--worker-args", nargs=argparse.REMAINDER, default=[],
+                        help="extra arguments passed to every category_worker.py")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--socket", choices=["req", "dealer"], default="req")
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json",
+                        help="wire format for requests, responses and worker messages")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--tasks-per-request", type=int, default=20)
+    parser.add_argument("--replay", default=None, help="JSONL file of request messages to replay")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a response")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=None, help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    results = run_load_test(args)
+    print(f"requests: {results['requests']}  tasks: {results['tasks']}  errors: {results['errors']}  "
+          f"rejected: {results['rejected']}")
+    print(f"throughput: {results['requests_per_s']:.1f} requests/s  {results['tasks_per_s']:.1f} tasks/s")
+    latency = results["latency_ms"]
+    print(f"latency: p50 {latency['p50']:.1f} ms  p95 {latency['p95']:.1f} ms  "
+          f"p99 {latency['p99']:.1f} ms  max {latency['max']:.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,63 @@
+"""
+Micro-benchmarks for the categorizer on its own, without ZeroMQ.
+
+    python benchmarks/micro_benchmarks.py --tasks 2000 --output micro.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+
+from load_test import synthetic_requests, git_commit  # noqa: E402
+from keyword_index import KeywordIndex  # noqa: E402
+from task_categorizer import TaskCategorization  # noqa: E402
+
+
+def time_per_call(function, items: list, repeat: int) -> float:
+    """Returns the best average seconds per item over several passes"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, (time.perf_counter() - start) / len(items))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks preprocess_string and find_category")
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    tasks = [task["task"] for task in synthetic_requests(1, args.tasks)[0]["tasks"]]
+    keyword_index = KeywordIndex.from_database()
+    processed = [TaskCategorization.preprocess_string(task) for task in tasks]
+
+    # find_category is an instance method so one categorizer is reused for every task
+    categorizer = TaskCategorization("0", tasks[0], keyword_index)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "preprocess_string_us": time_per_call(TaskCategorization.preprocess_string, tasks, args.repeat) * 1e6,
+            "find_category_us": time_per_call(categorizer.find_category, processed, args.repeat) * 1e6,
+            "categorize_batch_us": time_per_call(
+                lambda batch: TaskCategorization.categorize_batch(batch, keyword_index), [tasks], args.repeat
+            ) * 1e6 / len(tasks),
+        }
+
+    for name, value in results.items():
+        print(f"{name:>22}: {value:10.2f} us per task")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"commit": git_commit(), "tasks": args.tasks, "keywords": len(keyword_index),
+                       "results": results}, file, indent=2)
@@ -0,0 +1,68 @@
+"""
+Measures worker cold start: the time from starting a new interpreter to the first categorized
+task.  Each run is a fresh process so nothing is shared between runs.
+
+    python benchmarks/startup_benchmark.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs inside the child process and prints its own timings as the last line
+CHILD_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo!r})
+from task_categorizer import TaskCategorization
+from keyword_index import KeywordIndex
+imported = time.perf_counter()
+index = KeywordIndex.from_database()
+loaded = time.perf_counter()
+TaskCategorization.categorize_batch(["Clean the living room"], index)
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "load_index": loaded - imported,
+                  "first_response": done - loaded}}))
+"""
+
+
+def run_once() -> dict:
+    """Starts one cold process and returns its timings in seconds"""
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", CHILD_SCRIPT.format(repo=REPO_DIR)],
+                               cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    total = time.perf_counter() - start
+
+    timings = json.loads(completed.stdout.strip().splitlines()[-1])
+    timings["total"] = total
+    return timings
+
+
+def summarize(runs: list) -> dict:
+    """Returns the min/median/max of each timing across runs"""
+    summary = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        summary[name] = {"min": min(values), "median": statistics.median(values), "max": max(values)}
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks import-to-first-response time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=None, help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    results = summarize([run_once() for _ in range(args.runs)])
+    for name, values in results.items():
+        print(f"{name:>15}: min {values['min'] * 1000:8.1f} ms  median {values['median'] * 1000:8.1f} ms  "
+              f"max {values['max'] * 1000:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"runs": args.runs, "results": results}, file, indent=2)
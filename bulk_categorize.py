@@ -0,0 +1,187 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from keyword_index import KeywordIndex
+from keyword_snapshot import load_snapshot
+from result_cache import CategoryCache
+from task_categorizer import TaskCategorization
+
+logger = logging.getLogger(__name__)
+
+# the keyword index, cache and scoring engine of a pool process, set by init_process
+_keyword_index = None
+_cache = None
+_scoring_engine = None
+
+
+def init_process(snapshot_path: str, cache_size: int, scoring: str):
+    """
+    Pool initializer, loads the keyword store once per process.
+    :param snapshot_path: snapshot file to load, the database is used if None
+    :param cache_size: number of task categories each process remembers
+    :param scoring: python or sparse
+    """
+    global _keyword_index, _cache, _scoring_engine
+    _keyword_index = load_snapshot(snapshot_path) if snapshot_path else KeywordIndex.from_database()
+    _cache = CategoryCache(max_size=cache_size)
+    _cache.set_version(_keyword_index.version)
+    if scoring == "sparse":
+        from sparse_scoring import SparseScoringEngine
+        _scoring_engine = SparseScoringEngine()
+
+
+def categorize_chunk(texts: list) -> list:
+    """
+    Categorizes a chunk of task texts in a pool process.  Only the categories are sent back
+    so the parent keeps the rest of each task.
+    :param texts: list of task strings
+    :return: list of category names in the same order
+    """
+    categories = [_cache.get(text) for text in texts]
+    misses = [text_no for text_no, category in enumerate(categories) if category is None]
+    if misses:
+        new_categories = TaskCategorization.categorize_batch([texts[text_no] for text_no in misses],
+                                                             _keyword_index, _scoring_engine)
+        for text_no, category in zip(misses, new_categories):
+            categories[text_no] = category
+            _cache.put(texts[text_no], category)
+    return categories
+
+
+def read_tasks(file):
+    """
+    Reads tasks from a JSONL file one line at a time.
+    :param file: an open text file
+    :return: generator of {"task_id": ..., "task": ...} dictionaries
+    """
+    for line_no, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            yield {"task_id": str(line_no), "task": record}
+        elif "tasks" in record:
+            yield from record["tasks"]
+        else:
+            yield record
+
+
+def read_chunks(tasks, chunk_size: int):
+    """Groups tasks into lists of chunk_size tasks"""
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress:
+    """Represents the progress report written to stderr"""
+    def __init__(self, interval=5.0):
+        self._interval = interval
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self.tasks = 0
+
+    def add(self, num_tasks: int):
+        """Counts finished tasks and reports if the interval has passed"""
+        self.tasks += num_tasks
+        if self._interval and time.monotonic() - self._last_report >= self._interval:
+            self.report()
+
+    def report(self, final=False):
+        """Writes the tasks done so far and the throughput"""
+        elapsed = time.monotonic() - self._started
+        rate = self.tasks / elapsed if elapsed else 0.0
+        label = "done" if final else "progress"
+        print(f"{label}: {self.tasks} tasks in {elapsed:.1f}s ({rate:.0f} tasks/s)", file=sys.stderr, flush=True)
+        self._last_report = time.monotonic()
+
+
+def write_results(output, tasks: list, categories: list):
+    """Writes a chunk of categorized tasks as JSONL"""
+    output.write("".join(json.dumps({"task_id": task.get("task_id"), "task": task["task"], "category": category})
+                         + "\n" for task, category in zip(tasks, categories)))
+
+
+def bulk_categorize(input_file, output, processes=None, chunk_size=500, window=None, snapshot_path=None,
+                    cache_size=10000, scoring="python", progress_interval=5.0) -> int:
+    """
+    Categorizes every task in the input and writes them to the output in the same order.  At
+    most window chunks are in the pool at once, so memory does not grow with the input size.
+    :param input_file: an open JSONL file of tasks or requests
+    :param output: an open file the JSONL results are written to
+    :param processes: number of pool processes, defaults to the CPU count
+    :param chunk_size: tasks sent to a process at once
+    :param window: chunks in the pool at once, defaults to twice the number of processes
+    :param snapshot_path: snapshot file to load the keywords from instead of the database
+    :param cache_size: number of task categories each process remembers
+    :param scoring: python or sparse
+    :param progress_interval: seconds between progress reports, 0 turns them off
+    :return: number of tasks categorized
+    """
+    processes = processes or os.cpu_count() or 1
+    window = window or processes * 2
+    progress = Progress(progress_interval)
+
+    with multiprocessing.Pool(processes, initializer=init_process,
+                              initargs=(snapshot_path, cache_size, scoring)) as pool:
+        # chunks in the pool in input order as (tasks, async result)
+        pending = deque()
+        for chunk in read_chunks(read_tasks(input_file), chunk_size):
+            if len(pending) >= window:
+                tasks, result = pending.popleft()
+                write_results(output, tasks, result.get())
+                progress.add(len(tasks))
+            pending.append((chunk, pool.apply_async(categorize_chunk, ([task["task"] for task in chunk],))))
+
+        while pending:
+            tasks, result = pending.popleft()
+            write_results(output, tasks, result.get())
+            progress.add(len(tasks))
+
+    progress.report(final=True)
+    return progress.tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Categorizes a JSONL file of tasks with a process pool")
+    parser.add_argument("input", help="JSONL file with a request message, a {task_id, task} object or a "
+                                      "task string per line, - for stdin")
+    parser.add_argument("--output", default="-",
+                        help="JSONL file of {task_id, task, category} in input order, - for stdout")
+    parser.add_argument("--processes", type=int, default=None, help="defaults to the CPU count")
+    parser.add_argument("--chunk-size", type=int, default=500, help="tasks sent to a process at once")
+    parser.add_argument("--window", type=int, default=None,
+                        help="chunks in the pool at once, defaults to twice the number of processes")
+    parser.add_argument("--snapshot", default=None,
+                        help="snapshot file to load the keywords from instead of the database")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="number of task categories each process remembers")
+    parser.add_argument("--scoring", choices=["python", "sparse"], default="python",
+                        help="sparse scores each chunk with numpy/scipy matrices")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="seconds between progress reports on stderr, 0 turns them off")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, "r")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        bulk_categorize(input_file, output, processes=args.processes, chunk_size=max(1, args.chunk_size),
+                        window=args.window, snapshot_path=args.snapshot, cache_size=args.cache_size,
+                        scoring=args.scoring, progress_interval=args.progress_interval)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,20 @@
+import enum
+from typing import Union
+
+
+class Categories(enum.Enum):
+    work = "work"
+    school = "school"
+    home = "home"
+    health = "health/fitness"
+    personal = "personal"
+    shopping = "shopping"
+    finance = "finance"
+
+    @classmethod
+    def get_enum_from_display(cls, display_name: str) -> Union[enum, None]:
+        """Receives the display name for a unit and returns the RecipeUnit"""
+        for category in cls:
+            if category.value == display_name:
+                return category
+        return None
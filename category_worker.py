@@ -1,50 +1,219 @@
+import argparse
+import logging
+import os
+import socket
+import time
 import zmq
 import json
 from task_categorizer import TaskCategorization
+from keyword_index import KeywordIndex
+from keyword_snapshot import load_snapshot, fetch_snapshot
+from result_cache import CategoryCache
+from sparse_scoring import SparseScoringEngine
+from instrumentation import metrics
+from profiling import Profiler
+from wire_format import encode, decode
 import signal
-from datetime import datetime
+
+logger = logging.getLogger(__name__)
 
 
 class CategoryWorker:
     """Represents a worker who categorizes tasks"""
-    def __init__(self, host="localhost", port=8889):
+    def __init__(self, host="localhost", port=8889, keyword_index: KeywordIndex = None, updates_port=None,
+                 cache_size=10000, cache_path=None, scoring="python", stats_port=None, stats_interval=60.0,
+                 credit=2, heartbeat_interval=1.0, keyword_source="server", snapshot_path=None,
+                 worker_id=None):
+        # names the worker in logs and profile dumps
+        self._worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._host = host
+        self._port = port
         self._context = zmq.Context()
 
+        # for receiving keyword updates from the server, subscribed before the keywords are
+        # loaded so no update made after the snapshot is missed
+        if updates_port is None:
+            updates_port = port + 1  # 8890
+        self._updates_socket = self._context.socket(zmq.SUB)
+        self._updates_socket.connect(f"tcp://{host}:{updates_port}")
+        self._updates_socket.setsockopt(zmq.SUBSCRIBE, b"keyword")
+
+        # loads the keywords once so tasks are scored without database queries, from the
+        # server's snapshot by default so the worker does not need the database file
+        self._keyword_source = keyword_source
+        stale = keyword_index is not None or snapshot_path is not None
+        if keyword_index is None:
+            keyword_index = self.load_keywords(snapshot_path, wait=True)
+        # an index inherited from the pool or read from a file may be older than the keyword
+        # store, and updates published before the subscription above never reach this worker
+        if stale:
+            keyword_index = self.catch_up(keyword_index)
+        self._keyword_index = keyword_index
+        logger.info("Worker loaded %d keywords at version %d", len(self._keyword_index), self._keyword_index.version)
+
+        # scores whole chunks with one matrix multiply when requested
+        self._scoring_engine = SparseScoringEngine() if scoring == "sparse" else None
+
+        # remembers the category of tasks that were already seen
+        self._cache = CategoryCache(max_size=cache_size, path=cache_path)
+
         self._deal_socket = self._context.socket(zmq.DEALER)
         self._deal_socket.connect(f"tcp://{host}:{port}")
-        print(f"Worker created and connected to dealersocket {self._deal_socket}")
+        logger.info("Worker connected to tcp://%s:%d", host, port)
+
+        # tells the server how many chunks it may send before a result comes back
+        self._credit = max(1, credit)
+        self._heartbeat_interval = heartbeat_interval
+        self._deal_socket.send_multipart([b"READY", str(self._credit).encode()])
+        self._last_heartbeat = time.monotonic()
 
         self._poller = zmq.Poller()
         self._poller.register(self._deal_socket, zmq.POLLIN)
+        self._poller.register(self._updates_socket, zmq.POLLIN)
+
+        # for reporting the worker's timers and counters
+        self._stats_socket = None
+        if stats_port is not None:
+            self._stats_socket = self._context.socket(zmq.REP)
+            self._stats_socket.bind(f"tcp://*:{stats_port}")
+            self._poller.register(self._stats_socket, zmq.POLLIN)
+            logger.info("Worker stats available on port %d", stats_port)
+        self._stats_interval = stats_interval
+        self._last_stats_dump = time.monotonic()
 
         # for handling socket close
         signal.signal(signal.SIGINT, self.close)
         signal.signal(signal.SIGTERM, self.close)
 
+        # profiles the event loop when TASK_CATEGORIZER_PROFILE is set or on SIGUSR1
+        self._profiler = Profiler("worker", self._worker_id)
+
     def process_tasks(self):
         """
         Handles the main event loop for listening for tasks calling the task categorizer and
         returning a category.
         """
         while True:
-            sockets = dict(self._poller.poll())
+            sockets = dict(self._poller.poll(int(self._heartbeat_interval * 1000)))
+
+            # applies any keyword updates before categorizing
+            if sockets.get(self._updates_socket) == zmq.POLLIN:
+                self.process_update()
 
             # checks for a message, processes it and returns the category
             if sockets.get(self._deal_socket) == zmq.POLLIN:
-                # receives and unpacks the message
-                message = self._deal_socket.recv_multipart()  # {task_id:, task:}
-                print(f"Worker {self} received message: {message} {datetime.now()}")
-                client_id = message[0]
-                tasks = message[1]
-                task = json.loads(tasks.decode('utf-8'))
+                self.process_message()
 
-                # gets the response to send
-                response = self.get_category(task)
+            if self._stats_socket is not None and sockets.get(self._stats_socket) == zmq.POLLIN:
+                self._stats_socket.recv()
+                self._stats_socket.send_json(self.get_stats())
+
+            if time.monotonic() - self._last_heartbeat >= self._heartbeat_interval:
+                self._deal_socket.send_multipart([b"HEARTBEAT", str(self._credit).encode()])
+                self._last_heartbeat = time.monotonic()
+
+            if self._stats_interval and time.monotonic() - self._last_stats_dump >= self._stats_interval:
+                logger.info("Worker stats: %s", json.dumps(self.get_stats()))
+                self._last_stats_dump = time.monotonic()
+
+            self._profiler.tick()
+
+    def process_message(self):
+        """Categorizes one message of tasks from the server and sends back the response"""
+        # receives and unpacks the message, every frame between the command and the payload
+        # is an envelope (client id, request id, chunk number, encoding) that is echoed back to the server
+        # [TASK, client_id, request_id, chunk_no, encoding, [{task_id:, task:}]]
+        message = self._deal_socket.recv_multipart(copy=False)
+        logger.debug("Worker received message: %s", message)
+        if message[0].bytes != b"TASK":
+            return
+        envelope = [frame.bytes for frame in message[1:-1]]
+        encoding = envelope[-1].decode()
+        with metrics.timer(f"{encoding}_decode"):
+            payload = decode(message[-1].buffer, encoding)
+
+        # gets the response to send, a chunk of tasks is categorized together
+        with metrics.timer("categorize_chunk"):
+            if isinstance(payload, list):
+                response = self.get_categories(payload)
+            else:
+                response = self.get_category(payload)
+        metrics.increment("chunks")
+        metrics.increment("tasks", len(payload) if isinstance(payload, list) else 1)
+
+        # sends message to main server
+        logger.debug("Worker sending: %s", response)
+        with metrics.timer(f"{encoding}_encode"):
+            encoded_response = encode(response, encoding)
+        self._deal_socket.send_multipart([b"RESULT"] + envelope + [encoded_response], copy=False)
+        # a result also tells the server the worker is alive
+        self._last_heartbeat = time.monotonic()
+
+    def process_update(self):
+        """
+        Receives a keyword update from the server and applies it to the keyword index.  If an
+        update was missed the index is reloaded from the server's snapshot or the database.
+        """
+        topic, update = self._updates_socket.recv_multipart()
+        delta = json.loads(update.decode('utf-8'))
 
-                # sends message to main server
-                print(f"about to send:{response} {datetime.now()}")
-                json_response = json.dumps(response).encode()
-                self._deal_socket.send_multipart([client_id, json_response])
+        if not self._keyword_index.apply_delta(delta["version"], delta["keywords"]):
+            logger.info("Worker missed keyword updates, resyncing at version %d", delta["version"])
+            metrics.increment("keyword_resyncs")
+            try:
+                self._keyword_index = self.load_keywords()
+            except Exception as e:
+                # a server timeout or a database error keeps the old keywords, the next update tries again
+                logger.warning("Keyword resync failed: %s", e)
+
+    def load_keywords(self, snapshot_path=None, wait=False) -> KeywordIndex:
+        """
+        Loads the keyword index from a snapshot file, the database or the server.  A snapshot
+        file is only used at startup, resyncs fetch the server's current snapshot.
+        :param snapshot_path: optional snapshot file to load
+        :param wait: keep asking the server until it answers
+        :return: A populated KeywordIndex
+        """
+        if snapshot_path is not None:
+            return load_snapshot(snapshot_path)
+        if self._keyword_source == "database":
+            return KeywordIndex.from_database()
+
+        while True:
+            try:
+                return fetch_snapshot(self._context, self._host, self._port)
+            except TimeoutError as e:
+                if not wait:
+                    raise
+                logger.warning("%s, still waiting", e)
+
+    def catch_up(self, keyword_index: KeywordIndex, timeout=5.0) -> KeywordIndex:
+        """
+        Reloads a keyword index that is behind the keyword store.  The server only sends a
+        snapshot if its version differs, so an up to date index costs one round trip.
+        :param keyword_index: the index the worker started with
+        :param timeout: seconds to wait for the server
+        :return: the same index if it is current otherwise a newly loaded one
+        """
+        try:
+            if self._keyword_source == "database":
+                from task_category_db import TaskCategoryDatabase
+                if TaskCategoryDatabase().get_keyword_version() == keyword_index.version:
+                    return keyword_index
+                current = KeywordIndex.from_database()
+            else:
+                current = fetch_snapshot(self._context, self._host, self._port, timeout, keyword_index)
+        except Exception as e:
+            # a server timeout or a database error keeps the inherited keywords, the gap check in
+            # process_update resyncs once the next update arrives
+            logger.warning("Could not check the keyword version, starting at version %d: %s",
+                           keyword_index.version, e)
+            return keyword_index
+
+        if current is not keyword_index:
+            metrics.increment("keyword_resyncs")
+            logger.info("Worker caught up from keyword version %d to %d", keyword_index.version, current.version)
+        return current
 
     def get_category(self, task:dict) -> dict:
         """
@@ -53,25 +222,85 @@ class CategoryWorker:
         :param task: a dictionary of the task w/ id and task
         :return: A dictionary with the task and category
         """
-        # gets the categorization
-        categorizer = TaskCategorization(task["task_id"], task["task"])
-        category = categorizer.get_category()
-
-        # creates message w/ new c ategory
-        result = {
-            "task_id": task['task_id'],
-            "task": task['task'],
-            "category": category
-        }
-        return result
+        return self.get_categories([task])[0]
+
+    def get_categories(self, tasks: list) -> list:
+        """
+        Calls the batch task categorizer for the tasks in a chunk that are not cached and
+        creates the response message to send to server.
+        :param tasks: a list of task dictionaries w/ id and task
+        :return: A list of dictionaries with the task and category in the same order
+        """
+        # drops cached categories from older keyword versions
+        self._cache.set_version(self._keyword_index.version)
+
+        categories = [self._cache.get(task["task"]) for task in tasks]
+        misses = [task_no for task_no, category in enumerate(categories) if category is None]
+
+        # only the uncached tasks are categorized
+        if misses:
+            new_categories = TaskCategorization.categorize_batch([tasks[task_no]["task"] for task_no in misses],
+                                                                 self._keyword_index, self._scoring_engine)
+            for task_no, category in zip(misses, new_categories):
+                categories[task_no] = category
+                self._cache.put(tasks[task_no]["task"], category)
+
+        return [{"task_id": task["task_id"], "task": task["task"], "category": category}
+                for task, category in zip(tasks, categories)]
+
+    def get_stats(self) -> dict:
+        """Returns the worker's timers, counters and cache counters"""
+        stats = metrics.snapshot()
+        stats["cache"] = self._cache.get_stats()
+        stats["keyword_version"] = self._keyword_index.version
+        stats["worker_id"] = self._worker_id
+        return stats
 
     def close(self, signalnum, frame):
         """Handles closing a socket"""
+        self._profiler.close()
+        self._cache.close()
+        logger.info("Worker stats: %s", json.dumps(self.get_stats()))
         self._deal_socket.close()
+        self._updates_socket.close()
+        if self._stats_socket is not None:
+            self._stats_socket.close()
         self._context.term()
-        print("Workers closed")
+        logger.info("Worker closed")
 
 
 if __name__ == "__main__":
-    worker = CategoryWorker(host="localhost", port=8889)
+    parser = argparse.ArgumentParser(description="Runs a task categorizer worker")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8889)
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="number of task categories kept in memory")
+    parser.add_argument("--cache-path", default=None,
+                        help="SQLite file for a cache that survives restarts")
+    parser.add_argument("--scoring", choices=["python", "sparse"], default="python",
+                        help="sparse scores each chunk with numpy/scipy matrices")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="port for a REP socket that answers with the worker's stats")
+    parser.add_argument("--stats-interval", type=float, default=60.0,
+                        help="seconds between stats log lines, 0 turns them off")
+    parser.add_argument("--credit", type=int, default=2,
+                        help="chunks the server may send before a result comes back")
+    parser.add_argument("--heartbeat-interval", type=float, default=1.0,
+                        help="seconds between heartbeats sent to the server")
+    parser.add_argument("--keywords", choices=["server", "database"], default="server",
+                        help="load keywords from the server's snapshot or the local database")
+    parser.add_argument("--snapshot", default=None,
+                        help="snapshot file to load the keywords from at startup")
+    parser.add_argument("--worker-id", default=None,
+                        help="name used in logs and profile dumps, defaults to host-pid")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every message")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    worker = CategoryWorker(host=args.host, port=args.port, cache_size=args.cache_size,
+                            cache_path=args.cache_path, scoring=args.scoring,
+                            stats_port=args.stats_port, stats_interval=args.stats_interval,
+                            credit=args.credit, heartbeat_interval=args.heartbeat_interval,
+                            keyword_source=args.keywords, snapshot_path=args.snapshot,
+                            worker_id=args.worker_id)
     worker.process_tasks()
\ No newline at end of file
@@ -0,0 +1,139 @@
+import logging
+import queue
+import threading
+import time
+from task_category_db import TaskCategoryDatabase
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackWriter(threading.Thread):
+    """
+    Represents a background writer for user feedback.  Feedback is queued so the server can
+    answer straight away, duplicates are coalesced and the links are committed together once
+    a batch is full or the oldest queued feedback has waited long enough.  A batch that fails
+    to commit, for example while a bulk import holds the database, is kept and retried with
+    a growing delay.  At most one batch of feedback is accepted but not committed at any time,
+    so a crash loses at most the last un-flushed batch.
+    """
+    def __init__(self, database: TaskCategoryDatabase = None, max_batch=100, max_delay=0.05, max_backoff=5.0):
+        super().__init__(name="feedback-writer", daemon=True)
+        self._database = database if database is not None else TaskCategoryDatabase()
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        # longest wait between retries of a batch that failed to commit (seconds)
+        self._max_backoff = max_backoff
+
+        # one slot per accepted feedback that is not committed yet, submit refuses feedback
+        # once a whole batch is waiting so the server answers busy instead
+        self._backlog = threading.Semaphore(max_batch)
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+
+        # committed batches as (version, [(keyword, category)]) for the server to publish
+        self.committed = queue.Queue()
+
+    def submit(self, category: str, task: str) -> bool:
+        """
+        Queues a feedback keyword to be written.
+        :param category: the corrected category name
+        :param task: the task to add as a keyword
+        :return: False if a full batch is already waiting and the feedback was not accepted
+        """
+        if not self._backlog.acquire(blocking=False):
+            return False
+        self._queue.put((category, task, time.perf_counter()))
+        return True
+
+    def run(self):
+        """Collects queued feedback and commits it in batches until the writer is closed"""
+        pending = {}
+        first_queued = None
+        # feedback taken off the queue since the last commit, duplicates included
+        accepted = 0
+        # a batch that failed is retried no earlier than retry_at
+        retry_at = 0.0
+        backoff = self._max_delay
+
+        while not self._stopping.is_set():
+            # waits for feedback but no longer than the oldest pending item or the next retry allows
+            timeout = self._max_delay
+            if first_queued is not None:
+                timeout = max(0.0, max(first_queued + self._max_delay, retry_at) - time.monotonic())
+
+            try:
+                if self.add_pending(pending, *self._queue.get(timeout=timeout)):
+                    accepted += 1
+                    if first_queued is None:
+                        first_queued = time.monotonic()
+                else:
+                    self._backlog.release()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if pending and now >= retry_at and (len(pending) >= self._max_batch
+                                                or now - first_queued >= self._max_delay):
+                if self.write_batch(list(pending.values())):
+                    self._backlog.release(accepted)
+                    accepted = 0
+                    pending = {}
+                    first_queued = None
+                    retry_at = 0.0
+                    backoff = self._max_delay
+                else:
+                    retry_at = now + backoff
+                    backoff = min(backoff * 2, self._max_backoff)
+
+        # writes everything still queued in one last batch
+        while True:
+            try:
+                self.add_pending(pending, *self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if pending and not self.write_batch(list(pending.values())):
+            logger.error("Dropped %d feedback links that could not be written before closing", len(pending))
+
+    @staticmethod
+    def add_pending(pending: dict, category: str, task: str, queued_at: float) -> bool:
+        """
+        Adds queued feedback to the next batch, the same task and category is only written once.
+        :return: False if the feedback was malformed and dropped
+        """
+        try:
+            pending.setdefault((task.lower(), category), (category, task, queued_at))
+        except Exception as e:
+            # one bad item must not stop the writer thread
+            metrics.increment("feedback_dropped")
+            logger.error("Dropping malformed feedback %r for %r: %s", task, category, e)
+            return False
+        return True
+
+    def write_batch(self, links: list) -> bool:
+        """
+        Commits a batch of feedback and hands the new keywords to the server.
+        :param links: list of (category name, task, time queued) tuples
+        :return: True if the batch was committed otherwise False
+        """
+        try:
+            with metrics.timer("db_write"):
+                version, added = self._database.add_keyword_categories(
+                    [(category, task) for category, task, queued_at in links])
+        except Exception as e:
+            metrics.increment("feedback_write_errors")
+            logger.error("Error writing feedback batch of %d, retrying: %s", len(links), e)
+            return False
+
+        now = time.perf_counter()
+        for category, task, queued_at in links:
+            metrics.observe("feedback_queue_wait", now - queued_at)
+        metrics.increment("feedback_written", len(added))
+        if added:
+            self.committed.put((version, added))
+        return True
+
+    def close(self):
+        """Writes any queued feedback and stops the writer"""
+        self._stopping.set()
+        self.join()
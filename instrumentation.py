@@ -0,0 +1,94 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# histogram bucket upper bounds in seconds, from 10 microseconds to 100 seconds
+BUCKET_BOUNDS = [10 ** (exponent / 10) for exponent in range(-50, 21)]
+
+
+class Histogram:
+    """Represents a latency histogram with fixed logarithmic buckets"""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        """Adds a measurement to the histogram"""
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Estimates a percentile from the bucket upper bounds"""
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket_no, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[bucket_no], self.max) if bucket_no < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        """Returns the histogram as milliseconds"""
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.50) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000
+        }
+
+
+class Metrics:
+    """
+    Represents the timers and counters of one process.  Stages are timed with the monotonic
+    clock and kept in histograms so the server and workers can report them.
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Times the enclosed block and records it under the stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        """Records a measurement for a stage"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount=1):
+        """Adds to a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self) -> dict:
+        """Returns every histogram summary and counter"""
+        with self._lock:
+            return {
+                "uptime_s": time.monotonic() - self._started,
+                "timers": {name: histogram.summary() for name, histogram in sorted(self._histograms.items())},
+                "counters": dict(sorted(self._counters.items()))
+            }
+
+
+# the metrics of this process
+metrics = Metrics()
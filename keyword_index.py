@@ -0,0 +1,204 @@
+from typing import Iterable
+from categories import Categories
+from preprocessing import preprocess
+
+# marks the trie node where a keyword's token sequence ends
+KEYWORD_END = None
+
+
+class KeywordIndex:
+    """
+    Represents a read-optimized snapshot of the category keywords.  The snapshot is loaded
+    once and then used to score tasks without any database access.  Keywords are stored as
+    lemmatized token sequences in a token trie so single words and phrases are found in one
+    pass over the task.
+    """
+    def __init__(self, links: Iterable = (), version: int = 0):
+        # generation of the keyword store this snapshot reflects
+        self.version = version
+
+        # categories are kept in enum order so ties resolve the same way as before
+        self._categories = tuple(category.value for category in Categories)
+        self._category_pos = {name: pos for pos, name in enumerate(self._categories)}
+
+        # token sequence -> keyword id and keyword id -> {category position: weight}
+        self._keyword_ids = {}
+        self._keywords = []
+        self._weights = []
+
+        # nested {token: node} dictionaries, a node holds its keyword id under KEYWORD_END
+        self._trie = {}
+
+        for category, keyword in links:
+            self.add(keyword, category)
+
+    @classmethod
+    def from_token_links(cls, token_links: Iterable, version: int = 0) -> "KeywordIndex":
+        """
+        Builds an index from keywords that were already preprocessed, as stored in snapshots,
+        so no keyword is tokenized or lemmatized again.
+        :param token_links: iterable of (category name, token tuple, link count) tuples
+        :param version: the keyword store generation the links were read at
+        :return: A populated KeywordIndex
+        """
+        keyword_index = cls(version=version)
+        for category, tokens, links in token_links:
+            keyword_index.add_tokens(tokens, category, links=links)
+        return keyword_index
+
+    @classmethod
+    def from_database(cls, database=None) -> "KeywordIndex":
+        """
+        Loads every keyword/category link from the database into a new index.  The database
+        module is only imported here so workers using snapshots never open SQLite.
+        :param database: an open TaskCategoryDatabase, a new one is created if not provided
+        :return: A populated KeywordIndex
+        """
+        if database is None:
+            from task_category_db import TaskCategoryDatabase
+            database = TaskCategoryDatabase()
+        version, links = database.get_keyword_snapshot()
+        return cls(links, version)
+
+    def __len__(self):
+        return len(self._keywords)
+
+    @property
+    def categories(self) -> tuple:
+        """Getter for the category names in scoring order"""
+        return self._categories
+
+    def add(self, keyword: str, category: str) -> bool:
+        """
+        Adds a keyword/category link to the index.  A keyword scores one point for being in
+        the task and one more for each link to the category, which matches the original
+        exact-match scoring against the database.  Keywords are preprocessed like tasks so
+        keywords with the same lemmatized tokens share one entry.
+        :param keyword: the keyword text
+        :param category: the category display name
+        :return: True if added otherwise False
+        """
+        if category not in self._category_pos:
+            return False
+        return self.add_tokens(tuple(preprocess(keyword)), category, keyword)
+
+    def add_tokens(self, tokens: tuple, category: str, keyword: str = None, links=1) -> bool:
+        """
+        Adds a preprocessed keyword/category link to the index.
+        :param tokens: the lemmatized tokens of the keyword
+        :param category: the category display name
+        :param keyword: the keyword text, the tokens are used if not provided
+        :param links: number of keyword texts with these tokens linked to the category
+        :return: True if added otherwise False
+        """
+        pos = self._category_pos.get(category)
+        # keywords made only of filler words or punctuation can never match a task
+        if pos is None or not tokens:
+            return False
+
+        keyword_id = self._keyword_ids.get(tokens)
+        if keyword_id is None:
+            keyword_id = len(self._keywords)
+            self._keyword_ids[tokens] = keyword_id
+            self._keywords.append(keyword if keyword is not None else " ".join(tokens))
+            self._weights.append({})
+
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[KEYWORD_END] = keyword_id
+
+        weights = self._weights[keyword_id]
+        weights[pos] = weights.get(pos, 1) + links
+        return True
+
+    def token_links(self):
+        """
+        Yields every keyword/category link with the keyword's preprocessed tokens, used to
+        write snapshots that can be loaded without preprocessing.
+        :return: generator of (category name, token tuple, link count) tuples
+        """
+        for tokens, keyword_id in self._keyword_ids.items():
+            for pos, weight in self._weights[keyword_id].items():
+                yield self._categories[pos], tokens, weight - 1
+
+    def weight_entries(self):
+        """
+        Yields every non-zero keyword weight, used to build matrix scoring engines.
+        :return: generator of (keyword id, category position, weight) tuples
+        """
+        for keyword_id, weights in enumerate(self._weights):
+            for pos, weight in weights.items():
+                yield keyword_id, pos, weight
+
+    def apply_delta(self, version: int, links: list) -> bool:
+        """
+        Applies a published keyword update to the index.  Updates that are already reflected
+        in the snapshot are ignored.
+        :param version: the keyword store generation created by the update
+        :param links: list of (keyword, category) pairs added by the update
+        :return: False if an update was missed and the index needs a full resync otherwise True
+        """
+        if version <= self.version:
+            return True
+        if version != self.version + 1:
+            return False
+
+        for keyword, category in links:
+            self.add(keyword, category)
+        self.version = version
+        return True
+
+    def match(self, tokens: list) -> set:
+        """
+        Finds the keywords and phrases that appear in the processed task.  The trie is walked
+        from each token for as long as the following tokens continue a keyword, so the cost
+        depends on the task and the phrase length rather than the number of keywords.
+        :param tokens: list of tokens from the client task
+        :return: set of matching keyword ids
+        """
+        trie = self._trie
+        keyword_ids = set()
+        for start in range(len(tokens)):
+            node = trie.get(tokens[start])
+            pos = start + 1
+            while node is not None:
+                keyword_id = node.get(KEYWORD_END)
+                if keyword_id is not None:
+                    keyword_ids.add(keyword_id)
+                if pos == len(tokens):
+                    break
+                node = node.get(tokens[pos])
+                pos += 1
+        return keyword_ids
+
+    def score(self, tokens: list) -> list:
+        """
+        Scores the processed task against every category.
+        :param tokens: list of tokens from the client task
+        :return: list of scores in the same order as categories
+        """
+        return self.score_matches(self.match(tokens))
+
+    def score_matches(self, keyword_ids: set) -> list:
+        """
+        Scores a set of matched keywords against every category.
+        :param keyword_ids: keyword ids returned by match
+        :return: list of scores in the same order as categories
+        """
+        scores = [0] * len(self._categories)
+        for keyword_id in keyword_ids:
+            for pos, weight in self._weights[keyword_id].items():
+                scores[pos] += weight
+        return scores
+
+    def best_category(self, scores: list) -> str:
+        """
+        Picks the category with the highest score, defaulting to personal when nothing matched.
+        :param scores: list of scores in the same order as categories
+        :return: name of category with most matches
+        """
+        best = max(range(len(scores)), key=scores.__getitem__)
+        if scores[best] == 0:
+            return Categories.personal.value
+        return self._categories[best]
@@ -0,0 +1,158 @@
+import argparse
+import mmap
+import os
+import struct
+import zmq
+from keyword_index import KeywordIndex
+
+# file layout, every number is little-endian so snapshots move between hosts:
+#   header     magic, keyword store version, category count, keyword count, link count
+#   categories one length byte and the UTF-8 display name per category
+#   offsets    (keyword count + 1) offsets into the keyword tokens
+#   keywords   the UTF-8 lemmatized tokens of each keyword joined by TOKEN_SEPARATOR, back to back
+#   links      one (keyword number, category number, link count) triple per keyword/category pair
+# keywords are stored preprocessed so loading a snapshot never tokenizes or lemmatizes, which
+# means the writer and the readers need the same lemma table
+SNAPSHOT_MAGIC = b"KWSNAP02"
+HEADER = struct.Struct("<8sQIII")
+OFFSET = struct.Struct("<I")
+LINK = struct.Struct("<IBI")
+TOKEN_SEPARATOR = "\0"
+
+
+def encode_snapshot(keyword_index: KeywordIndex) -> bytes:
+    """
+    Encodes a keyword index as a snapshot.
+    :param keyword_index: the index to encode
+    :return: the snapshot bytes
+    """
+    categories = list(keyword_index.categories)
+    category_nos = {name: category_no for category_no, name in enumerate(categories)}
+
+    keyword_nos = {}
+    keywords = []
+    packed_links = []
+    for category, tokens, links in keyword_index.token_links():
+        keyword_no = keyword_nos.get(tokens)
+        if keyword_no is None:
+            keyword_no = keyword_nos[tokens] = len(keywords)
+            keywords.append(TOKEN_SEPARATOR.join(tokens).encode("utf-8"))
+        packed_links.append(LINK.pack(keyword_no, category_nos[category], links))
+
+    offsets = [0]
+    for keyword in keywords:
+        offsets.append(offsets[-1] + len(keyword))
+
+    parts = [HEADER.pack(SNAPSHOT_MAGIC, keyword_index.version, len(categories), len(keywords),
+                         len(packed_links))]
+    for name in categories:
+        encoded_name = name.encode("utf-8")
+        parts.append(bytes([len(encoded_name)]) + encoded_name)
+    parts.extend(OFFSET.pack(offset) for offset in offsets)
+    parts.extend(keywords)
+    parts.extend(packed_links)
+    return b"".join(parts)
+
+
+def decode_snapshot(data) -> KeywordIndex:
+    """
+    Builds a keyword index from a snapshot.  The keyword tokens go straight into the index
+    without being preprocessed again.
+    :param data: the snapshot as bytes, a memoryview or an mmap
+    :return: A populated KeywordIndex
+    """
+    view = memoryview(data)
+    try:
+        magic, version, num_categories, num_keywords, num_links = HEADER.unpack_from(view, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a keyword snapshot or an unsupported snapshot format")
+
+        pos = HEADER.size
+        categories = []
+        for _ in range(num_categories):
+            length = view[pos]
+            categories.append(bytes(view[pos + 1:pos + 1 + length]).decode("utf-8"))
+            pos += 1 + length
+
+        offsets = [offset for offset, in OFFSET.iter_unpack(view[pos:pos + (num_keywords + 1) * OFFSET.size])]
+        pos += (num_keywords + 1) * OFFSET.size
+        keywords = [tuple(str(view[pos + start:pos + end], "utf-8").split(TOKEN_SEPARATOR))
+                    for start, end in zip(offsets, offsets[1:])]
+        pos += offsets[-1]
+
+        token_links = ((categories[category_no], keywords[keyword_no], links) for keyword_no, category_no, links
+                       in LINK.iter_unpack(view[pos:pos + num_links * LINK.size]))
+        return KeywordIndex.from_token_links(token_links, version)
+    finally:
+        view.release()
+
+
+def load_snapshot(path: str) -> KeywordIndex:
+    """
+    Builds a keyword index from a snapshot file.  The file is memory-mapped rather than read.
+    :param path: the snapshot file
+    :return: A populated KeywordIndex
+    """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            return decode_snapshot(snapshot)
+
+
+def write_snapshot(path: str, keyword_index: KeywordIndex) -> int:
+    """
+    Writes a snapshot file.  The file is renamed into place so readers never see a partial one.
+    :param path: the snapshot file
+    :param keyword_index: the index to write
+    :return: the size of the snapshot in bytes
+    """
+    data = encode_snapshot(keyword_index)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, path)
+    return len(data)
+
+
+def fetch_snapshot(context, host: str, port: int, timeout: float = 30.0,
+                   current: KeywordIndex = None) -> KeywordIndex:
+    """
+    Asks the server for its current snapshot over the worker port.  A separate DEALER socket
+    is used so the reply cannot be mixed up with task messages.  When an index is passed in
+    its version is sent along and the server only sends a snapshot if it has a different one.
+    :param context: the ZeroMQ context to create the socket in
+    :param host: the server host
+    :param port: the server's worker port
+    :param timeout: seconds to wait for the server
+    :param current: the index the caller already has, returned as is if it is up to date
+    :return: A populated KeywordIndex
+    """
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(f"tcp://{host}:{port}")
+    try:
+        socket.send_multipart([b"SNAPSHOT"] if current is None else [b"SNAPSHOT", str(current.version).encode()])
+        if not socket.poll(int(timeout * 1000)):
+            raise TimeoutError(f"no keyword snapshot from {host}:{port} after {timeout} seconds")
+        # [SNAPSHOT, version, snapshot] or [SNAPSHOT, version] when the caller's version is current
+        reply = socket.recv_multipart(copy=False)
+        if len(reply) < 3:
+            return current
+        return decode_snapshot(reply[-1].buffer)
+    finally:
+        socket.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the keyword store as a snapshot file for workers")
+    parser.add_argument("path", help="snapshot file to write, or to read with --info")
+    parser.add_argument("--info", action="store_true", help="print the version and size of a snapshot")
+    args = parser.parse_args()
+
+    if args.info:
+        with open(args.path, "rb") as file:
+            keyword_index = decode_snapshot(file.read())
+        print(f"{args.path}: version {keyword_index.version}, {len(keyword_index)} keywords")
+    else:
+        keyword_index = KeywordIndex.from_database()
+        size = write_snapshot(args.path, keyword_index)
+        print(f"Wrote version {keyword_index.version} with {len(keyword_index)} keywords ({size} bytes) to {args.path}")
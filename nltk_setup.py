@@ -0,0 +1,65 @@
+import argparse
+import os
+import nltk
+
+# corpora the categorizer needs, as (nltk.data path, download package name)
+REQUIRED_RESOURCES = [
+    ("corpora/stopwords", "stopwords"),
+    ("tokenizers/punkt", "punkt"),
+    ("tokenizers/punkt_tab", "punkt_tab"),
+    ("corpora/wordnet", "wordnet"),
+]
+
+# vendored corpora live next to the code unless TASK_CATEGORIZER_NLTK_DATA points elsewhere
+NLTK_DATA_DIR = os.environ.get("TASK_CATEGORIZER_NLTK_DATA",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "nltk_data"))
+
+
+def use_local_data():
+    """Adds the vendored corpora directory to the NLTK search path without touching the network"""
+    if os.path.isdir(NLTK_DATA_DIR) and NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+
+
+def missing_resources() -> list:
+    """Returns the download package names of required corpora that are not installed locally"""
+    missing = []
+    for path, package in REQUIRED_RESOURCES:
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(package)
+    return missing
+
+
+def provision(download_dir: str = NLTK_DATA_DIR) -> bool:
+    """
+    Downloads the required corpora.  This is the only place the categorizer uses the network
+    and is run once when a node is set up.
+    :param download_dir: directory to store the corpora in
+    :return: True if every corpus is available afterwards otherwise False
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    for path, package in REQUIRED_RESOURCES:
+        nltk.download(package, download_dir=download_dir)
+
+    if download_dir not in nltk.data.path:
+        nltk.data.path.insert(0, download_dir)
+    return not missing_resources()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Downloads the NLTK corpora used by the task categorizer")
+    parser.add_argument("--dir", default=NLTK_DATA_DIR, help="directory to store the corpora in")
+    parser.add_argument("--check", action="store_true",
+                        help="only report missing corpora without downloading")
+    args = parser.parse_args()
+
+    if args.check:
+        use_local_data()
+        missing = missing_resources()
+        print(f"Missing corpora: {', '.join(missing)}" if missing else "All corpora installed")
+    elif provision(args.dir):
+        print(f"Corpora installed in {args.dir}")
+    else:
+        print(f"Could not install: {', '.join(missing_resources())}")
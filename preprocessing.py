@@ -0,0 +1,311 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import re
+import string
+import struct
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# words in a task, split the way nltk.word_tokenize splits them without running Punkt
+TOKEN_PATTERN = re.compile(r"""
+      \.\.\.                                    # ellipsis
+    | (?:[^\W\d_]\.){2,}(?![^\W\d_])            # acronyms such as e.g. and u.s.
+    | (?:[^\s.,:;!?@\#$%&()\[\]{}<>"']          # words, hyphens and numbers stay together
+       | [.](?=[^\s.,:;!?'"()\[\]{}<>])         # inner periods as in file.txt or 3.5
+       | [,:](?=\d)                             # separators in numbers as in 1,000 or 10:30
+       | '(?=\w)                                # apostrophes inside words, split below
+      )+
+    | \S                                        # any other punctuation on its own
+""", re.VERBOSE)
+
+# clitics the treebank tokenizer splits off the end of a word
+CLITIC_PATTERN = re.compile(r"(?i)^(.+?)(n't|'ll|'re|'ve|'s|'m|'d)$")
+
+# words the treebank tokenizer splits in two
+SPLIT_WORDS = {
+    "cannot": ("can", "not"),
+    "gimme": ("gim", "me"),
+    "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"),
+    "lemme": ("lem", "me"),
+    "wanna": ("wan", "na"),
+}
+
+PUNCTUATION = frozenset(string.punctuation)
+
+# characters an opening double quote follows
+OPENING_CONTEXT = frozenset(" \t\n([{<")
+
+# lemma tables are kept next to the code unless TASK_CATEGORIZER_LEMMA_TABLE points elsewhere
+LEMMA_TABLE_PATH = os.environ.get("TASK_CATEGORIZER_LEMMA_TABLE",
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "lemma_table.bin"))
+
+# file layout: magic, entry count, (count + 1) little-endian offsets, then the sorted entries
+# each entry is "word\0lemma" with an empty lemma when the word is its own lemma
+TABLE_MAGIC = b"LEMTAB01"
+HEADER = struct.Struct("<8sI")
+OFFSET = struct.Struct("<I")
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits text into word and punctuation tokens with one compiled regex.  The output matches
+    nltk.word_tokenize for task strings, run `python preprocessing.py --compare` to check a corpus.
+    :param text: the text to split
+    :return: list of tokens
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if token == '"':
+            # the treebank tokenizer turns double quotes into opening and closing quotes
+            start = match.start()
+            tokens.append("``" if start == 0 or text[start - 1] in OPENING_CONTEXT else "''")
+        elif token in SPLIT_WORDS:
+            tokens.extend(SPLIT_WORDS[token])
+        elif "'" in token:
+            clitic = CLITIC_PATTERN.match(token)
+            tokens.extend(clitic.groups() if clitic else (token,))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+@lru_cache(maxsize=None)
+def get_filler_words() -> frozenset:
+    """Loads the english stopwords once per process"""
+    from nltk.corpus import stopwords
+    from nltk_setup import use_local_data
+    use_local_data()
+    return frozenset(stopwords.words("english"))
+
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    """Creates the WordNet lemmatizer once per process, only needed for words the table lacks"""
+    from nltk.stem import WordNetLemmatizer
+    from nltk_setup import use_local_data
+    use_local_data()
+    return WordNetLemmatizer()
+
+
+class LemmaTable:
+    """
+    Represents a read-only word to lemma table precomputed from WordNet.  The table file is
+    memory-mapped so it loads instantly and every worker on a host shares the same pages.
+    Words that are not in the table fall back to the WordNet lemmatizer and every lookup is
+    memoized.
+    """
+    def __init__(self, path: str = LEMMA_TABLE_PATH, memo_size=100000):
+        self._memo = {}
+        self._memo_size = memo_size
+        self._mmap = None
+        self._count = 0
+
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._count = HEADER.unpack_from(self._mmap, 0)
+            if magic != TABLE_MAGIC:
+                logger.warning("Ignoring lemma table %s with an unknown format", path)
+                self._mmap.close()
+                self._mmap = None
+                self._count = 0
+        else:
+            logger.warning("No lemma table at %s, every word uses the WordNet lemmatizer", path)
+
+        # entries start after the header and the offsets
+        self._entries_start = HEADER.size + (self._count + 1) * OFFSET.size
+
+    def __len__(self):
+        return self._count
+
+    def lemmatize(self, word: str) -> str:
+        """
+        Returns the lemma of a word.
+        :param word: a lowercase token
+        :return: the lemma
+        """
+        lemma = self._memo.get(word)
+        if lemma is None:
+            lemma = self.lookup(word)
+            if lemma is None:
+                lemma = get_lemmatizer().lemmatize(word)
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[word] = lemma
+        return lemma
+
+    def lookup(self, word: str):
+        """
+        Binary searches the table for a word.
+        :param word: a lowercase token
+        :return: the lemma or None if the word is not in the table
+        """
+        if self._mmap is None:
+            return None
+        key = word.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.entry(middle)
+            entry_key = entry[:entry.index(b"\0")]
+            if entry_key < key:
+                low = middle + 1
+            elif entry_key > key:
+                high = middle
+            else:
+                lemma = entry[len(entry_key) + 1:]
+                return lemma.decode("utf-8") if lemma else word
+        return None
+
+    def entry(self, entry_no: int) -> bytes:
+        """Returns the raw bytes of an entry"""
+        start = OFFSET.unpack_from(self._mmap, HEADER.size + entry_no * OFFSET.size)[0]
+        end = OFFSET.unpack_from(self._mmap, HEADER.size + (entry_no + 1) * OFFSET.size)[0]
+        return self._mmap[self._entries_start + start:self._entries_start + end]
+
+    def close(self):
+        """Unmaps the table file"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._count = 0
+
+
+@lru_cache(maxsize=None)
+def get_lemma_table() -> LemmaTable:
+    """Opens the lemma table once per process"""
+    return LemmaTable()
+
+
+def preprocess(text: str) -> list:
+    """
+    Turns text into the lemmatized tokens used for matching, dropping punctuation and filler
+    words.  Tasks and keywords both go through this so they compare equal.
+    :param text: a task or keyword
+    :return: list of lemmatized tokens
+    """
+    filler_words = get_filler_words()
+    lemma_table = get_lemma_table()
+    return [lemma_table.lemmatize(token) for token in tokenize(text.lower())
+            if token not in PUNCTUATION and token not in filler_words]
+
+
+def write_lemma_table(lemmas: dict, path: str = LEMMA_TABLE_PATH) -> int:
+    """
+    Writes a word to lemma mapping as a table file.  The file is written next to the target
+    and renamed into place so running workers never see a partial table.
+    :param lemmas: dictionary of word -> lemma
+    :param path: the table file to write
+    :return: the number of entries written
+    """
+    entries = []
+    for word in sorted(lemmas, key=lambda word: word.encode("utf-8")):
+        lemma = lemmas[word]
+        entries.append(word.encode("utf-8") + b"\0" + (b"" if lemma == word else lemma.encode("utf-8")))
+
+    offsets = [0]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry))
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(TABLE_MAGIC, len(entries)))
+        file.write(b"".join(OFFSET.pack(offset) for offset in offsets))
+        file.write(b"".join(entries))
+    os.replace(temp_path, path)
+    return len(entries)
+
+
+def inflections(word: str) -> list:
+    """Returns the regular plural and verb forms of a base word"""
+    forms = [word + "s", word + "es", word + "ed", word + "ing"]
+    if word.endswith("y") and len(word) > 1 and word[-2] not in "aeiou":
+        forms.extend([word[:-1] + "ies", word[:-1] + "ied"])
+    if word.endswith("e"):
+        forms.extend([word + "d", word[:-1] + "ing"])
+    return forms
+
+
+def corpus_words(file_name: str = "starter_tasks.json") -> set:
+    """Returns every token in the starter keywords so the table covers the task vocabulary"""
+    words = set()
+    if os.path.exists(file_name):
+        with open(file_name, "r") as file:
+            for keywords in json.load(file).values():
+                for keyword in keywords:
+                    words.update(tokenize(keyword.lower()))
+    return words
+
+
+def build_lemma_table(path: str = LEMMA_TABLE_PATH, extra_words=()) -> int:
+    """
+    Precomputes the lemma of every single-word WordNet lemma, their regular inflections,
+    the irregular noun forms and any extra words with the real lemmatizer.
+    :param path: the table file to write
+    :param extra_words: more words to include, e.g. the keyword vocabulary
+    :return: the number of entries written
+    """
+    from nltk.corpus import wordnet
+    lemmatizer = get_lemmatizer()
+
+    words = set(extra_words)
+    for name in wordnet.all_lemma_names():
+        if "_" in name:
+            continue
+        words.add(name)
+        words.update(inflections(name))
+    words.update(form for form in wordnet._exception_map["n"] if "_" not in form)
+
+    lemmas = {word: lemmatizer.lemmatize(word) for word in words if word and "\0" not in word}
+    return write_lemma_table(lemmas, path)
+
+
+def compare_tokenizers(texts: list) -> list:
+    """
+    Runs the regex tokenizer and nltk.word_tokenize over the same texts.
+    :param texts: texts to tokenize
+    :return: list of (text, regex tokens, nltk tokens) for every text they disagree on
+    """
+    import nltk
+    from nltk_setup import use_local_data
+    use_local_data()
+
+    mismatches = []
+    for text in texts:
+        expected = nltk.word_tokenize(text)
+        tokens = tokenize(text)
+        if tokens != expected:
+            mismatches.append((text, tokens, expected))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the lemma table and checks the regex tokenizer")
+    parser.add_argument("--build", action="store_true", help="precompute the lemma table from WordNet")
+    parser.add_argument("--path", default=LEMMA_TABLE_PATH, help="lemma table file")
+    parser.add_argument("--compare", default=None, nargs="?", const="starter_tasks.json",
+                        help="compare the tokenizer with nltk on the keywords of a JSON file "
+                             "or the task field of a JSONL file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    if args.build:
+        count = build_lemma_table(args.path, corpus_words())
+        print(f"Wrote {count} lemmas to {args.path}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            if args.compare.endswith(".jsonl"):
+                texts = [json.loads(line)["task"] for line in file if line.strip()]
+            else:
+                texts = [keyword for keywords in json.load(file).values() for keyword in keywords]
+        mismatches = compare_tokenizers([text.lower() for text in texts])
+        for text, tokens, expected in mismatches:
+            print(f"{text!r}: regex {tokens} nltk {expected}")
+        print(f"{len(texts) - len(mismatches)} of {len(texts)} texts tokenized the same")
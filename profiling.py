@@ -0,0 +1,129 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import socket
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# seconds to profile from startup, 1 or on means the default window, unset or 0 leaves profiling
+# off until SIGUSR1
+PROFILE_ENV = "TASK_CATEGORIZER_PROFILE"
+# seconds each SIGUSR1 profiling window lasts
+PROFILE_WINDOW_ENV = "TASK_CATEGORIZER_PROFILE_WINDOW"
+# directory the profile dumps are written to
+PROFILE_DIR_ENV = "TASK_CATEGORIZER_PROFILE_DIR"
+
+DEFAULT_WINDOW = 30.0
+
+
+def env_seconds(name: str, default: float) -> float:
+    """
+    Reads a number of seconds from the environment.
+    :param name: the environment variable
+    :param default: seconds used when the variable is unset
+    :return: the seconds, the default window for values such as "1" or "on" and 0 for "off"
+    """
+    value = os.environ.get(name, "").strip().lower()
+    if not value:
+        return default
+    if value in ("0", "off", "false", "no"):
+        return 0.0
+    try:
+        seconds = float(value)
+    except ValueError:
+        return DEFAULT_WINDOW
+    # a bare switch such as 1 means the default window rather than one second
+    return DEFAULT_WINDOW if seconds == 1 else seconds
+
+
+class Profiler:
+    """
+    Represents an opt-in profiling switch for a long running process.  A window of cProfile
+    profiling and tracemalloc allocation tracking is started by the TASK_CATEGORIZER_PROFILE
+    environment variable or a SIGUSR1 signal.  When the window ends the profile and the top
+    allocations are written to files tagged with the role and id of the process.  The
+    event loop calls tick, which only checks two attributes while profiling is off.
+    """
+    def __init__(self, role: str, tag: str = None, output_dir: str = None, window: float = None,
+                 top_allocations=50):
+        self._role = role
+        self._tag = tag or f"{socket.gethostname()}-{os.getpid()}"
+        self._output_dir = output_dir or os.environ.get(PROFILE_DIR_ENV, "profiles")
+        self._window = window or env_seconds(PROFILE_WINDOW_ENV, DEFAULT_WINDOW)
+        self._top_allocations = top_allocations
+
+        # set by the signal handler, the window itself is started from the event loop
+        self._requested = None
+        self._profile = None
+        self._ends_at = 0.0
+
+        startup_window = env_seconds(PROFILE_ENV, 0.0)
+        if startup_window > 0:
+            self._requested = startup_window
+
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.request)
+
+    def request(self, signalnum=None, frame=None, window: float = None):
+        """Asks for a profiling window, also used as the SIGUSR1 handler"""
+        self._requested = window or self._window
+
+    def tick(self):
+        """Starts a requested window or finishes one that has run its length"""
+        if self._requested is not None:
+            self.start(self._requested)
+        elif self._profile is not None and time.monotonic() >= self._ends_at:
+            self.stop()
+
+    def start(self, window: float):
+        """Starts profiling and allocation tracking for window seconds"""
+        self._requested = None
+        self._ends_at = time.monotonic() + window
+        if self._profile is not None:
+            # a request during a window extends it
+            return
+        logger.info("Profiling %s %s for %.0f seconds", self._role, self._tag, window)
+        tracemalloc.start(10)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self) -> list:
+        """
+        Stops the current window and writes its dumps.
+        :return: the files written
+        """
+        if self._profile is None:
+            return []
+        self._profile.disable()
+        allocations = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        prefix = os.path.join(self._output_dir, f"{self._role}-{self._tag}-{int(time.time())}")
+
+        # the raw profile for snakeviz or pstats and a readable summary
+        self._profile.dump_stats(prefix + ".prof")
+        summary = io.StringIO()
+        pstats.Stats(self._profile, stream=summary).sort_stats("cumulative").print_stats(40)
+        with open(prefix + ".txt", "w") as file:
+            file.write(summary.getvalue())
+        self._profile = None
+
+        with open(prefix + ".alloc.txt", "w") as file:
+            file.write(f"traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n")
+            for statistic in allocations.statistics("lineno")[:self._top_allocations]:
+                file.write(f"{statistic}\n")
+
+        files = [prefix + ".prof", prefix + ".txt", prefix + ".alloc.txt"]
+        logger.info("Wrote profile of %s %s to %s", self._role, self._tag, ", ".join(files))
+        return files
+
+    def close(self):
+        """Writes the dumps of a window that is still running"""
+        self.stop()
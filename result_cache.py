@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import sqlite3
+from collections import OrderedDict
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_task(task: str) -> str:
+    """Lowercases a task and collapses its whitespace so repeated tasks share a cache entry"""
+    return " ".join(task.lower().split())
+
+
+class CategoryCache:
+    """
+    Represents a two tier cache of task categories.  The first tier is a bounded LRU in
+    memory keyed on the normalized task text.  The optional second tier is a SQLite file
+    keyed on a hash of the normalized text that survives restarts.  Entries are tied to the
+    keyword store version and are invalidated when the keywords change.
+    """
+    def __init__(self, max_size=10000, path=None, flush_size=100):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._version = None
+
+        # counters for sizing the cache
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # disk writes are buffered and written together
+        self._flush_size = flush_size
+        self._pending_writes = []
+        self._disk = None
+        if path is not None:
+            self._disk = sqlite3.connect(path, timeout=5)
+            # pool workers can share one file, write-ahead logging lets them read while another writes
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("CREATE TABLE IF NOT EXISTS category_cache ("
+                               "task_hash TEXT PRIMARY KEY, version INTEGER NOT NULL, category TEXT NOT NULL)")
+            self._disk.commit()
+
+    def set_version(self, version: int):
+        """
+        Ties the cache to a keyword store version.  A new version clears the memory tier and
+        deletes disk entries from other versions so the file does not keep growing.
+        :param version: the keyword store generation of the index in use
+        """
+        if version != self._version:
+            if self._version is not None:
+                self.invalidations += 1
+                self._entries.clear()
+                self._pending_writes.clear()
+            self._version = version
+            self.prune()
+
+    def prune(self):
+        """Deletes disk entries that belong to other keyword versions"""
+        if self._disk is None:
+            return
+        try:
+            self._disk.execute("DELETE FROM category_cache WHERE version != ?", (self._version,))
+            self._disk.commit()
+        except sqlite3.Error as e:
+            # stale rows only cost space, another worker or the next version deletes them
+            self._disk.rollback()
+            logger.warning("Could not prune the disk cache: %s", e)
+
+    def get(self, task: str) -> Union[str, None]:
+        """
+        Looks up the category for a task.
+        :param task: the task text
+        :return: the cached category or None on a miss
+        """
+        key = normalize_task(task)
+        category = self._entries.get(key)
+        if category is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return category
+
+        if self._disk is not None:
+            try:
+                row = self._disk.execute("SELECT category FROM category_cache WHERE task_hash = ? AND version = ?",
+                                         (self.hash_task(key), self._version)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning("Could not read the disk cache: %s", e)
+                row = None
+            if row is not None:
+                self.disk_hits += 1
+                self._store(key, row[0])
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, task: str, category: str):
+        """
+        Adds a categorized task to the cache.
+        :param task: the task text
+        :param category: the category name
+        """
+        key = normalize_task(task)
+        self._store(key, category)
+
+        if self._disk is not None:
+            self._pending_writes.append((self.hash_task(key), self._version, category))
+            if len(self._pending_writes) >= self._flush_size:
+                self.flush()
+
+    def _store(self, key: str, category: str):
+        """Adds an entry to the memory tier, evicting the least recently used entry if full"""
+        self._entries[key] = category
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def flush(self):
+        """Writes the buffered entries to the disk tier, dropping them if the file is busy"""
+        if self._disk is None or not self._pending_writes:
+            return
+        try:
+            self._disk.executemany("INSERT OR REPLACE INTO category_cache (task_hash, version, category) "
+                                   "VALUES (?, ?, ?)", self._pending_writes)
+            self._disk.commit()
+        except sqlite3.Error as e:
+            # the entries are still in memory and are only cached, so they are not retried
+            self._disk.rollback()
+            logger.warning("Could not write %d entries to the disk cache: %s", len(self._pending_writes), e)
+        self._pending_writes.clear()
+
+    def close(self):
+        """Flushes and closes the disk tier"""
+        if self._disk is not None:
+            self.flush()
+            self._disk.close()
+            self._disk = None
+
+    def get_stats(self) -> dict:
+        """Returns the cache counters"""
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+    @staticmethod
+    def hash_task(key: str) -> str:
+        """Returns the content hash used as the disk tier key"""
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
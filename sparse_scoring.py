@@ -0,0 +1,89 @@
+from keyword_index import KeywordIndex
+from categories import Categories
+
+# numpy/scipy are optional, the pure python scoring in KeywordIndex is used without them
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+
+class SparseScoringEngine:
+    """
+    Represents a vectorized scoring engine.  The keyword index is turned into a sparse
+    keyword x category weight matrix and a batch of tasks into a sparse task x keyword
+    matrix, so every category score in the batch comes from one matrix multiply.  Results
+    match KeywordIndex.score and KeywordIndex.best_category.
+    """
+    def __init__(self):
+        if sparse is None:
+            raise ImportError("SparseScoringEngine requires numpy and scipy")
+
+        # the weight matrix is rebuilt when the index or its version changes
+        self._keyword_index = None
+        self._version = None
+        self._num_keywords = 0
+        self._weights = None
+
+    def get_weights(self, keyword_index: KeywordIndex):
+        """
+        Returns the keyword x category weight matrix for an index, building it if the index
+        has changed since the last call.
+        :param keyword_index: the keyword snapshot
+        :return: A CSR matrix of keyword weights
+        """
+        if (self._keyword_index is not keyword_index or self._version != keyword_index.version
+                or self._num_keywords != len(keyword_index)):
+            rows, cols, data = [], [], []
+            for keyword_id, pos, weight in keyword_index.weight_entries():
+                rows.append(keyword_id)
+                cols.append(pos)
+                data.append(weight)
+
+            shape = (len(keyword_index), len(keyword_index.categories))
+            self._weights = sparse.csr_matrix((np.array(data, dtype=np.int32), (rows, cols)), shape=shape)
+            self._keyword_index = keyword_index
+            self._version = keyword_index.version
+            self._num_keywords = len(keyword_index)
+        return self._weights
+
+    def score_batch(self, processed_tasks: list, keyword_index: KeywordIndex):
+        """
+        Scores a batch of preprocessed tasks against every category.
+        :param processed_tasks: a list of token lists
+        :param keyword_index: the keyword snapshot
+        :return: A dense task x category array of scores
+        """
+        weights = self.get_weights(keyword_index)
+
+        # encodes each task as a row of the keywords it matched
+        indptr = [0]
+        indices = []
+        for tokens in processed_tasks:
+            indices.extend(keyword_index.match(tokens))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.int32)
+        tasks = sparse.csr_matrix((data, indices, indptr), shape=(len(processed_tasks), weights.shape[0]))
+
+        return (tasks @ weights).toarray()
+
+    def categorize(self, processed_tasks: list, keyword_index: KeywordIndex) -> list:
+        """
+        Picks the best category for each task in a batch.
+        :param processed_tasks: a list of token lists
+        :param keyword_index: the keyword snapshot
+        :return: a list of category names in the same order as the tasks
+        """
+        if not processed_tasks:
+            return []
+
+        scores = self.score_batch(processed_tasks, keyword_index)
+        # argmax keeps the first highest category, the same tie-break as the python scoring
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+
+        categories = keyword_index.categories
+        personal = Categories.personal.value
+        return [categories[pos] if score > 0 else personal for pos, score in zip(best.tolist(), best_scores.tolist())]
@@ -1,27 +1,54 @@
-import string
-from datetime import datetime
-from task_category_db import TaskCategoryDatabase, Categories
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-nltk.download('stopwords')
-nltk.download('punkt')
-nltk.download('punkt_tab')
-nltk.download('wordnet')
+from categories import Categories
+from keyword_index import KeywordIndex
+from nltk_setup import use_local_data
+from preprocessing import PUNCTUATION, tokenize, get_filler_words, get_lemma_table
+from instrumentation import metrics
+
+# corpora are only loaded from disk, run nltk_setup.py to provision them
+use_local_data()
 
 
 class TaskCategorization:
     """Represents a categorized task """
-    def __init__(self, task_id, task):
+    def __init__(self, task_id, task, keyword_index: KeywordIndex = None):
         self._task_id = task_id
         self._task = task
         self._categories = None
-        self._database = TaskCategoryDatabase()
+        # loads a one-off snapshot if the caller does not share one
+        if keyword_index is None:
+            keyword_index = KeywordIndex.from_database()
+        self._keyword_index = keyword_index
 
         self.get_categories()
         self._processed_task = self.preprocess_string(self._task)
         self._category = self.find_category(self._processed_task)
 
+    @classmethod
+    def categorize_batch(cls, tasks: list, keyword_index: KeywordIndex = None, scoring_engine=None) -> list:
+        """
+        Categorizes a batch of tasks against one shared keyword snapshot.
+        :param tasks: a list of task strings
+        :param keyword_index: the keyword snapshot, loaded from the database if not provided
+        :param scoring_engine: optional engine that scores the whole batch at once,
+        e.g. a SparseScoringEngine
+        :return: a list of category names in the same order as the tasks
+        """
+        if keyword_index is None:
+            keyword_index = KeywordIndex.from_database()
+
+        processed_tasks = [cls.preprocess_string(task) for task in tasks]
+        if scoring_engine is not None:
+            with metrics.timer("scoring"):
+                return scoring_engine.categorize(processed_tasks, keyword_index)
+
+        categories = []
+        for tokens in processed_tasks:
+            with metrics.timer("keyword_lookup"):
+                keyword_ids = keyword_index.match(tokens)
+            with metrics.timer("scoring"):
+                categories.append(keyword_index.best_category(keyword_index.score_matches(keyword_ids)))
+        return categories
+
     def get_category(self):
         """Getter for the category attribute"""
         return self._category
@@ -34,15 +61,17 @@ class TaskCategorization:
             for category in Categories:
                 self._categories[category.value] = 0
 
-    def preprocess_string(self, task:str) -> list:
+    @classmethod
+    def preprocess_string(cls, task:str) -> list:
         """Handles preprocessing of the task for use in db queries"""
         task = task.lower()
-        tokens = self.tokenize_string(task)
-        lemmed_tokens = self.lemmatize_tokens(tokens)
+        tokens = cls.tokenize_string(task)
+        lemmed_tokens = cls.lemmatize_tokens(tokens)
 
         return lemmed_tokens
 
-    def tokenize_string(self, task:str) -> list:
+    @staticmethod
+    def tokenize_string(task:str) -> list:
         """
         Separates the task string into individual words and removes
         punctuation/filler words
@@ -50,66 +79,47 @@ class TaskCategorization:
         :param task: a task to be categorized
         :return: a filtered list of the tokens
         """
-        # creates the tokens
-        tokens = nltk.word_tokenize(task)
-
-        # gets sets of punctuation/filler words
-        punctuation = set(string.punctuation)
-        filler_words = set(stopwords.words("english"))
+        with metrics.timer("tokenize"):
+            # creates the tokens with the regex tokenizer instead of nltk.word_tokenize
+            tokens = tokenize(task)
 
-        # removed the punctuation and filler word tokens
-        no_punctuation = [word for word in tokens if word not in punctuation]
-        filtered_tokens = [word for word in no_punctuation if word not in filler_words]
+            # removed the punctuation and filler word tokens
+            filler_words = get_filler_words()
+            filtered_tokens = [word for word in tokens if word not in PUNCTUATION and word not in filler_words]
 
         return filtered_tokens
 
-    def lemmatize_tokens(self, tokens:list) -> list:
+    @staticmethod
+    def lemmatize_tokens(tokens:list) -> list:
         """
-        Stems the tokens using a lemmatizer.
+        Stems the tokens with the precomputed lemma table, words missing from the
+        table fall back to the WordNet lemmatizer.
         :param tokens: a list of filtered tokens
         :return: a list of lemmatized tokens
         """
-        lemmatizer = WordNetLemmatizer()
-        lemmed_tokens = [lemmatizer.lemmatize(word) for word in tokens]
+        with metrics.timer("lemmatize"):
+            lemma_table = get_lemma_table()
+            lemmed_tokens = [lemma_table.lemmatize(word) for word in tokens]
 
         return lemmed_tokens
 
     def find_category(self, processed_tokens: list) -> str:
         """
-        Receives a list of tokens from pre-processing and compares it to the database
-        keywords.  Returns the category with the most matches to the task.
+        Receives a list of tokens from pre-processing and compares it to the keyword
+        snapshot.  Returns the category with the most matches to the task.
         :param processed_tokens: list of tokens from the client task
         :return: name of category with most matches
         """
-        print(f"finding category {datetime.now()}")
-
-        for key in self._categories:
-            # gets the keywords
-            cat_id = self._database.get_category_id(key)
-            keywords = self._database.get_all_keywords_for_category(cat_id)
-
-            matches = 0
-
-            # checks for exact matches
-            keyword_set = set(keywords)
-            matches += len(set(processed_tokens) & keyword_set)
-
-            # checks for tokens that partially match a phrase
-            for keyword in keywords:
-                for token in processed_tokens:
-                    if keyword in processed_tokens:
-                        matches += 1
-                        break
-
+        # scores the task against the in-memory keyword snapshot
+        with metrics.timer("keyword_lookup"):
+            keyword_ids = self._keyword_index.match(processed_tokens)
+        with metrics.timer("scoring"):
+            scores = self._keyword_index.score_matches(keyword_ids)
+        for name, matches in zip(self._keyword_index.categories, scores):
             # stores the number of hits
-            self._categories[key] = matches
-
-        # gets category with the most hits
-        category = max(self._categories, key=self._categories.get)
+            self._categories[name] = matches
 
-        # if the category has no hits then sets it to the default category personal
-        if self._categories[category] == 0:
-            category = "personal"
+        # gets category with the most hits or personal if nothing matched
+        category = self._keyword_index.best_category(scores)
 
-        print(f"returning category {datetime.now()}")
         return category
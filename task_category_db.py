@@ -1,27 +1,12 @@
-import enum
+import argparse
 import json
-from sqlalchemy import create_engine, Integer, String, ForeignKey
+from sqlalchemy import create_engine, event, inspect, select, text, Index, Integer, String, ForeignKey
 from sqlalchemy import Enum as SQLAEnum
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Mapped, mapped_column
 from contextlib import contextmanager
 from typing import Union
-
-class Categories(enum.Enum):
-    work = "work"
-    school = "school"
-    home = "home"
-    health = "health/fitness"
-    personal = "personal"
-    shopping = "shopping"
-    finance = "finance"
-
-    @classmethod
-    def get_enum_from_display(cls, display_name: str) -> Union[enum, None]:
-        """Receives the display name for a unit and returns the RecipeUnit"""
-        for category in cls:
-            if category.value == display_name:
-                return category
-        return None
+# categories live in their own module so workers can use them without the database
+from categories import Categories
 
 
 Base = declarative_base()
@@ -68,8 +53,37 @@ class CategoryKeyword(Base):
         return f"<CategoryKeyword(id={self.id!r}, category_id={self.category_id!r}, keyword_id={self.keyword_id!r})>"
 
 
+class KeywordVersion(Base):
+    """Represents the generation counter of the keyword store"""
+    __tablename__ = 'keyword_version'
+
+    id: Mapped[int] = mapped_column("keyword_version_id", Integer, primary_key=True)
+    version: Mapped[int] = mapped_column("version", Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<KeywordVersion(id={self.id!r}, version={self.version!r})>"
+
+
+# keyword lookups and link checks use these instead of scanning the tables
+keyword_name_index = Index("ux_keyword_keyword", Keyword.keyword_name, unique=True)
+category_keyword_index = Index("ux_category_keywords_category_keyword",
+                               CategoryKeyword.category_id, CategoryKeyword.keyword_id, unique=True)
+keyword_link_index = Index("ix_category_keywords_keyword_id", CategoryKeyword.keyword_id)
+
+
 # set up database engine
 engine = create_engine('sqlite+pysqlite:///task_category.db')
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Uses write-ahead logging so readers are not blocked while feedback is written"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 Base.metadata.create_all(bind=engine, checkfirst=True)
 Session = sessionmaker(bind=engine, expire_on_commit=False)
 
@@ -88,32 +102,123 @@ def add_categories():
 
 def add_starter_data(json_file):
     """Pre-adds the starter keywords to the database """
-    with open(json_file, "r") as file:
-        categories = json.load(file)
-    session = Session()
-    try:
-        # get category id
-        for category_name, keywords in categories.items():
-            category_id = get_category_id(category_name)
-            # loop over list of keywords
-            for keyword_name in keywords:
-                # check for duplicates
-                keyword = session.query(Keyword).filter_by(keyword_name=keyword_name).first()
+    bulk_import_keywords(json_file)
+
+
+def migrate_schema():
+    """
+    Brings an existing database up to the current schema.  Duplicate keywords are merged,
+    duplicate keyword/category links are removed and the indexes and unique constraints are
+    added.  Safe to run more than once and cheap once the indexes exist.
+    """
+    with engine.begin() as connection:
+        # a database with the unique indexes cannot hold duplicates, so there is nothing to do
+        existing = {index["name"] for table in ("keyword", "category_keywords")
+                    for index in inspect(connection).get_indexes(table)}
+        if {keyword_name_index.name, category_keyword_index.name, keyword_link_index.name} <= existing:
+            return
+
+        # points links at the first copy of each keyword and drops the other copies
+        connection.execute(text(
+            "UPDATE category_keywords SET keyword_id = ("
+            "SELECT MIN(duplicate.keyword_id) FROM keyword AS original "
+            "JOIN keyword AS duplicate ON original.keyword = duplicate.keyword "
+            "WHERE original.keyword_id = category_keywords.keyword_id) "
+            "WHERE keyword_id IN (SELECT keyword_id FROM keyword) AND keyword_id NOT IN ("
+            "SELECT MIN(keyword_id) FROM keyword GROUP BY keyword)"))
+        removed = connection.execute(text(
+            "DELETE FROM keyword WHERE keyword_id NOT IN (SELECT MIN(keyword_id) FROM keyword GROUP BY keyword)"
+        )).rowcount
+
+        # keeps one link per keyword/category pair
+        removed += connection.execute(text(
+            "DELETE FROM category_keywords WHERE category_keyword_id NOT IN ("
+            "SELECT MIN(category_keyword_id) FROM category_keywords GROUP BY category_id, keyword_id)"
+        )).rowcount
+
+        for index in (keyword_name_index, category_keyword_index, keyword_link_index):
+            index.create(bind=connection, checkfirst=True)
+
+        # the link weights changed so workers need to reload
+        if removed:
+            bump_keyword_version_sql(connection)
+
+
+def read_keyword_dump(file_name: str):
+    """
+    Reads a keyword dump.  JSON files map category names to lists of keywords like
+    starter_tasks.json, JSONL files have one {"category": ..., "keyword": ...} object per line.
+    :param file_name: path to the dump
+    :return: generator of (category name, keyword) tuples
+    """
+    with open(file_name, "r") as file:
+        if file_name.endswith(".jsonl"):
+            for line in file:
+                if line.strip():
+                    link = json.loads(line)
+                    yield link["category"], link["keyword"]
+        else:
+            for category_name, keywords in json.load(file).items():
+                for keyword_name in keywords:
+                    yield category_name, keyword_name
+
+
+def bulk_import_keywords(file_name: str, batch_size=10000) -> int:
+    """
+    Loads a JSON or JSONL keyword dump in one transaction.  Keywords and links are inserted
+    with executemany and duplicates are skipped by the unique indexes.
+    :param file_name: path to the dump
+    :param batch_size: number of links sent to the database per executemany
+    :return: the number of new keyword/category links
+    """
+    migrate_schema()
+    with engine.begin() as connection:
+        category_ids = {(name.value if isinstance(name, Categories) else name): category_id
+                        for category_id, name in connection.execute(select(Category.id, Category.name))}
+        links_before = connection.execute(text("SELECT COUNT(*) FROM category_keywords")).scalar()
+
+        batch = []
+        for category_name, keyword_name in read_keyword_dump(file_name):
+            category_id = category_ids.get(category_name)
+            keyword_name = keyword_name.strip().lower()
+            if category_id is None or not keyword_name:
+                continue
+            batch.append({"category_id": category_id, "keyword": keyword_name})
+            if len(batch) >= batch_size:
+                insert_keyword_links(connection, batch)
+                batch = []
+        insert_keyword_links(connection, batch)
+
+        links_added = connection.execute(text("SELECT COUNT(*) FROM category_keywords")).scalar() - links_before
+        if links_added:
+            bump_keyword_version_sql(connection)
+    return links_added
+
+
+def insert_keyword_links(connection, links: list):
+    """Helper method to insert a batch of keywords and links, skipping ones that already exist"""
+    if not links:
+        return
+    connection.execute(text("INSERT OR IGNORE INTO keyword (keyword) VALUES (:keyword)"), links)
+    connection.execute(text(
+        "INSERT OR IGNORE INTO category_keywords (category_id, keyword_id) "
+        "SELECT :category_id, keyword_id FROM keyword WHERE keyword = :keyword"), links)
 
-                if not keyword:
-                    # create keyword if it does not exist
-                    keyword = Keyword(keyword_name=keyword_name)
-                    session.add(keyword)
-                    session.flush()
 
-                # add keyword/category link to junction table
-                category_keyword = CategoryKeyword(category_id=category_id, keyword_id=keyword.id)
-                session.add(category_keyword)
+def bump_keyword_version_sql(connection):
+    """Helper method to increment the keyword generation counter inside an open connection"""
+    connection.execute(text("INSERT OR IGNORE INTO keyword_version (keyword_version_id, version) VALUES (1, 0)"))
+    connection.execute(text("UPDATE keyword_version SET version = version + 1 WHERE keyword_version_id = 1"))
 
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        return
+
+def bump_keyword_version(session) -> int:
+    """Helper method to increment the keyword generation counter inside an open session"""
+    keyword_version = session.get(KeywordVersion, 1)
+    if keyword_version is None:
+        keyword_version = KeywordVersion(id=1, version=0)
+        session.add(keyword_version)
+    keyword_version.version += 1
+    return keyword_version.version
 
 
 def get_category_id(display_name:str) -> int:
@@ -174,6 +279,35 @@ class TaskCategoryDatabase:
                 session.rollback()
                 return
 
+    def get_keyword_version(self) -> int:
+        """returns the current generation of the keyword store"""
+        with self.session_scope() as session:
+            keyword_version = session.get(KeywordVersion, 1)
+            return keyword_version.version if keyword_version else 0
+
+    def get_keyword_snapshot(self) -> tuple[int, list]:
+        """
+        Returns every keyword/category link in the database with a single query along with
+        the keyword store generation it was read at.  Used to build the in-memory keyword
+        index so categorization does not hit the database.  Database errors are raised rather
+        than returning an empty snapshot.
+        :return: Tuple of the version and a list of (category name, keyword) tuples
+        """
+        with engine.connect() as connection:
+            # pysqlite does not begin a transaction for a SELECT, so one is started by hand and
+            # the version and the links are read from the same snapshot of the database
+            connection.exec_driver_sql("BEGIN")
+            version = connection.execute(
+                select(KeywordVersion.version).where(KeywordVersion.id == 1)).scalar() or 0
+            links = connection.execute(
+                select(Category.name, Keyword.keyword_name).select_from(CategoryKeyword)
+                .join(Category, CategoryKeyword.category_id == Category.id)
+                .join(Keyword, CategoryKeyword.keyword_id == Keyword.id)).all()
+            connection.rollback()
+        # the category column loads as the enum so it is converted back to the display name
+        return version, [(name.value if isinstance(name, Categories) else name, keyword)
+                         for name, keyword in links]
+
     def add_keyword_category(self, category:str, task:str) -> bool:
         """
         Adds keywords to database with corrected category based on user feedback.
@@ -195,17 +329,64 @@ class TaskCategoryDatabase:
                     session.add(keyword)
                     session.flush()
 
-                # add keyword/category link to junction table
-                category_keyword = CategoryKeyword(category_id=category_id, keyword_id=keyword.id)
-                session.add(category_keyword)
+                # add keyword/category link to junction table unless it is already there
+                link = session.query(CategoryKeyword).filter_by(category_id=category_id,
+                                                                keyword_id=keyword.id).first()
+                if not link:
+                    category_keyword = CategoryKeyword(category_id=category_id, keyword_id=keyword.id)
+                    session.add(category_keyword)
+                    bump_keyword_version(session)
                 session.commit()
                 return True
             except Exception as e:
                 session.rollback()
                 return False
 
+    def add_keyword_categories(self, links: list) -> tuple[int, list]:
+        """
+        Adds a batch of feedback keywords in one transaction.  Links that already exist are
+        skipped and the keyword store version is bumped once for the whole batch.
+        :param links: list of (category name, task) tuples
+        :return: Tuple of the new version and the (keyword, category) links that were added
+        """
+        added = []
+        with engine.begin() as connection:
+            category_ids = {(name.value if isinstance(name, Categories) else name): category_id
+                            for category_id, name in connection.execute(select(Category.id, Category.name))}
+            for category, task in links:
+                category_id = category_ids.get(category)
+                if category_id is None:
+                    continue
+                keyword = task.lower()
+                connection.execute(text("INSERT OR IGNORE INTO keyword (keyword) VALUES (:keyword)"),
+                                   {"keyword": keyword})
+                result = connection.execute(text(
+                    "INSERT OR IGNORE INTO category_keywords (category_id, keyword_id) "
+                    "SELECT :category_id, keyword_id FROM keyword WHERE keyword = :keyword"),
+                    {"category_id": category_id, "keyword": keyword})
+                if result.rowcount:
+                    added.append((keyword, category))
+
+            if added:
+                bump_keyword_version_sql(connection)
+            version = connection.execute(text(
+                "SELECT version FROM keyword_version WHERE keyword_version_id = 1")).scalar() or 0
+        return version, added
+
 
 if __name__ == "__main__":
-    # initializes database
-    add_categories()
-    add_starter_data('starter_tasks.json')
+    parser = argparse.ArgumentParser(description="Initializes and maintains the task category database")
+    parser.add_argument("--import", dest="import_file", default=None,
+                        help="bulk import a JSON or JSONL keyword dump")
+    parser.add_argument("--migrate", action="store_true",
+                        help="dedupe an existing database and add the indexes")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_schema()
+    elif args.import_file:
+        print(f"Imported {bulk_import_keywords(args.import_file)} keyword links")
+    else:
+        # initializes database
+        add_categories()
+        add_starter_data('starter_tasks.json')
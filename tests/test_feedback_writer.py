@@ -0,0 +1,62 @@
+import time
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+class FakeDatabase:
+    """Records the feedback batches the writer commits"""
+    def __init__(self):
+        self.batches = []
+        self.locked = False
+
+    def add_keyword_categories(self, links: list) -> tuple:
+        if self.locked:
+            raise RuntimeError("database is locked")
+        self.batches.append(links)
+        return len(self.batches), [(task.lower(), category) for category, task in links]
+
+
+@pytest.fixture
+def writer(monkeypatch, tmp_path):
+    # task_category_db creates its SQLite file in the working directory when imported
+    monkeypatch.chdir(tmp_path)
+    from feedback_writer import FeedbackWriter
+    feedback_writer = FeedbackWriter(FakeDatabase(), max_delay=0.01)
+    feedback_writer.start()
+    yield feedback_writer
+    feedback_writer.close()
+
+
+def test_malformed_feedback_does_not_stop_the_writer(writer):
+    assert writer.submit("work", 123)
+    assert writer.submit("work", "Send the report")
+    writer.close()
+
+    assert not writer.is_alive()
+    assert writer.committed.get_nowait() == (1, [("send the report", "work")])
+
+
+def test_backlog_is_capped_at_one_batch_while_commits_fail(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    from feedback_writer import FeedbackWriter
+    database = FakeDatabase()
+    database.locked = True
+    writer = FeedbackWriter(database, max_batch=3, max_delay=0.01, max_backoff=0.05)
+    writer.start()
+    try:
+        assert all(writer.submit("work", f"task {task_no}") for task_no in range(3))
+        assert not writer.submit("work", "task 3")
+
+        # the kept batch is committed once the database is free and its slots are given back
+        database.locked = False
+        deadline = time.monotonic() + 5
+        while not database.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(task for category, task in database.batches[0]) == ["task 0", "task 1", "task 2"]
+        deadline = time.monotonic() + 5
+        while not writer.submit("work", "task 3"):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        writer.close()
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("zmq")
+
+from keyword_index import KeywordIndex
+from keyword_snapshot import decode_snapshot, encode_snapshot, load_snapshot, write_snapshot
+
+
+@pytest.fixture
+def keyword_index() -> KeywordIndex:
+    # token links are added directly so the tests do not need the NLTK data
+    return KeywordIndex.from_token_links([
+        ("home", ("mow", "lawn"), 3),
+        ("work", ("mow", "lawn"), 1),
+        ("work", ("report",), 2),
+        ("finance", ("pay", "rent", "online"), 1),
+        ("health/fitness", ("café",), 1),
+    ], version=7)
+
+
+def test_snapshot_round_trip_keeps_every_link(keyword_index):
+    decoded = decode_snapshot(encode_snapshot(keyword_index))
+    assert decoded.version == 7
+    assert len(decoded) == len(keyword_index)
+    assert sorted(decoded.token_links()) == sorted(keyword_index.token_links())
+    assert decoded.match(["please", "mow", "lawn"]) == keyword_index.match(["please", "mow", "lawn"])
+
+
+def test_snapshot_file_round_trip(keyword_index, tmp_path):
+    path = str(tmp_path / "keywords.snap")
+    assert write_snapshot(path, keyword_index) > 0
+    assert sorted(load_snapshot(path).token_links()) == sorted(keyword_index.token_links())
+
+
+def test_empty_snapshot_round_trip():
+    decoded = decode_snapshot(encode_snapshot(KeywordIndex(version=3)))
+    assert decoded.version == 3
+    assert list(decoded.token_links()) == []
+
+
+def test_snapshot_with_an_unknown_format_is_rejected(keyword_index):
+    with pytest.raises(ValueError):
+        decode_snapshot(b"KWSNAP01" + encode_snapshot(keyword_index)[8:])
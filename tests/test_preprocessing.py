@@ -0,0 +1,32 @@
+import pytest
+from preprocessing import LemmaTable, write_lemma_table
+
+
+@pytest.fixture
+def lemma_table(tmp_path):
+    path = str(tmp_path / "lemma_table.bin")
+    assert write_lemma_table({"tasks": "task", "task": "task", "geese": "goose", "cafés": "café"}, path) == 4
+    table = LemmaTable(path)
+    yield table
+    table.close()
+
+
+def test_lemma_table_finds_a_word(lemma_table):
+    assert lemma_table.lookup("tasks") == "task"
+    assert lemma_table.lookup("geese") == "goose"
+    assert lemma_table.lookup("cafés") == "café"
+
+
+def test_lemma_table_returns_a_word_that_is_its_own_lemma(lemma_table):
+    assert lemma_table.lookup("task") == "task"
+
+
+@pytest.mark.parametrize("word", ["lawn", "", "a", "zzz", "taskss"])
+def test_lemma_table_returns_none_for_a_missing_word(lemma_table, word):
+    assert lemma_table.lookup(word) is None
+
+
+def test_missing_lemma_table_has_no_entries(tmp_path):
+    table = LemmaTable(str(tmp_path / "missing.bin"))
+    assert len(table) == 0
+    assert table.lookup("tasks") is None
@@ -0,0 +1,44 @@
+import json
+import pytest
+from wire_format import JSON, MSGPACK, count_tasks, detect_encoding, decode, encode
+
+msgpack = pytest.importorskip("msgpack")
+
+
+def make_tasks(count: int) -> list:
+    return [{"task_id": str(task_no), "task": f"task {task_no}"} for task_no in range(count)]
+
+
+@pytest.mark.parametrize("count, header", [(0, 0x90), (15, 0x9f), (16, 0xdc), (65535, 0xdc), (65536, 0xdd)])
+def test_count_tasks_reads_msgpack_array_headers(count, header):
+    data = msgpack.packb(make_tasks(count))
+    assert data[0] == header
+    assert count_tasks(data, MSGPACK) == count
+
+
+@pytest.mark.parametrize("count", [0, 1, 16, 1000])
+def test_count_tasks_counts_json_task_keys(count):
+    assert count_tasks(json.dumps(make_tasks(count)).encode(), JSON) == count
+
+
+def test_count_tasks_ignores_task_keys_inside_task_text():
+    tasks = [{"task_id": "1", "task": 'fix the "task": field'}]
+    assert count_tasks(json.dumps(tasks).encode(), JSON) == 1
+
+
+@pytest.mark.parametrize("encoding", [JSON, MSGPACK])
+def test_count_tasks_counts_a_single_task_as_one(encoding):
+    # workers categorize a chunk that is not a list as one task, so it must not count as 0
+    assert count_tasks(encode(make_tasks(1)[0], encoding), encoding) == 1
+
+
+@pytest.mark.parametrize("data, encoding", [(b"", JSON), (b" [ ] ", JSON), (b"", MSGPACK)])
+def test_count_tasks_of_empty_chunks(data, encoding):
+    assert count_tasks(data, encoding) == 0
+
+
+@pytest.mark.parametrize("encoding", [JSON, MSGPACK])
+def test_encode_round_trip(encoding):
+    data = encode(make_tasks(3), encoding)
+    assert detect_encoding(data) == encoding
+    assert decode(memoryview(data)) == make_tasks(3)
@@ -0,0 +1,176 @@
+import json
+import signal
+import socket
+import threading
+import pytest
+
+zmq = pytest.importorskip("zmq")
+pytest.importorskip("sqlalchemy")
+
+
+class FakeFeedbackWriter:
+    """Stands in for the background feedback writer, the tests do not touch the database"""
+    def __init__(self, database=None):
+        self.submitted = []
+
+    def start(self):
+        pass
+
+    def submit(self, category: str, task: str) -> bool:
+        self.submitted.append((category, task))
+        return True
+
+    def close(self):
+        pass
+
+
+def free_port() -> int:
+    """Returns a port the server and the three ports after it can most likely bind"""
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    # task_category_db creates its SQLite file in the working directory when imported
+    monkeypatch.chdir(tmp_path)
+    import zeromq_server
+    monkeypatch.setattr(zeromq_server, "TaskCategoryDatabase", lambda: None)
+    monkeypatch.setattr(zeromq_server, "FeedbackWriter", FakeFeedbackWriter)
+    monkeypatch.setattr(signal, "signal", lambda signalnum, handler: None)
+
+    port = free_port()
+    category_server = zeromq_server.CategoryServer(port=port, chunk_size=2, task_timeout=10.0)
+    client = category_server._context.socket(zmq.DEALER)
+    client.setsockopt(zmq.LINGER, 0)
+    client.connect(f"tcp://localhost:{port}")
+    yield category_server, client
+    client.close()
+    category_server.close(None, None)
+
+
+def send_request(category_server, client, texts: list):
+    """Sends a buffered request and lets the server queue its chunks"""
+    tasks = [{"task_id": str(task_no), "task": text} for task_no, text in enumerate(texts)]
+    client.send_multipart([b"", json.dumps({"message type": "request", "tasks": tasks}).encode()])
+    assert category_server._frontend.poll(2000)
+    category_server.process_client_message()
+
+
+def send_result(category_server, worker, chunk):
+    """Answers a dispatched chunk as the given worker"""
+    client_id, request_id, chunk_no, encoding, payload, queued_at = chunk
+    tasks = [dict(task, category="work") for task in json.loads(bytes(payload))]
+    frames = [client_id, request_id, chunk_no, encoding, json.dumps(tasks).encode()]
+    category_server.process_result(worker, [zmq.Frame(frame) for frame in frames])
+
+
+def test_late_duplicate_result_of_coalesced_request_is_ignored(server):
+    import zeromq_server
+    category_server, client = server
+    first = category_server._workers[b"first"] = zeromq_server.WorkerState(b"first", 1)
+    second = category_server._workers[b"second"] = zeromq_server.WorkerState(b"second", 1)
+
+    send_request(category_server, client, [f"task {task_no}" for task_no in range(6)])
+    category_server.dispatch_tasks()
+    chunk_0 = category_server._outstanding[next(iter(first.in_flight))][0]
+    chunk_1 = category_server._outstanding[next(iter(second.in_flight))][0]
+
+    # chunk 0 times out and is sent again once the second worker has credit
+    category_server._outstanding[chunk_0[:3]][1] -= 60.0
+    category_server.check_workers()
+    send_result(category_server, second, chunk_1)
+    category_server.dispatch_tasks()
+    assert chunk_0[:3] in second.in_flight
+
+    # the second copy of chunk 0 finishes while chunk 2 is still out
+    send_result(category_server, second, chunk_0)
+    category_server.dispatch_tasks()
+    chunk_2 = category_server._outstanding[next(iter(second.in_flight))][0]
+    assert chunk_2[2] == b"2"
+
+    # the first worker's late copy of chunk 0 must not break the request
+    send_result(category_server, first, chunk_0)
+    assert category_server._in_flight
+
+    send_result(category_server, second, chunk_2)
+    assert not category_server._in_flight
+    assert client.poll(2000)
+    response = json.loads(client.recv_multipart()[-1])
+    assert [task["task_id"] for task in response["tasks"]] == [str(task_no) for task_no in range(6)]
+    assert {task["category"] for task in response["tasks"]} == {"work"}
+
+
+@pytest.mark.parametrize("task", [123, None, ["a task"], "", "   "])
+def test_feedback_with_a_task_that_is_not_text_is_rejected(server, task):
+    category_server, client = server
+    feedback = {"task": task, "category_provided": "personal", "category_feedback": "work"}
+    assert category_server.process_feedback({"message type": "feedback", "feedback": feedback}) is None
+    assert category_server._feedback_writer.submitted == []
+
+
+def test_feedback_is_queued_for_the_writer(server):
+    category_server, client = server
+    feedback = {"task": "Send the report", "category_provided": "personal", "category_feedback": "work"}
+    response = category_server.process_feedback({"message type": "feedback", "feedback": feedback})
+    assert response["message type"] == "response"
+    assert category_server._feedback_writer.submitted == [("work", "Send the report")]
+
+
+class SlowDatabase:
+    """Stands in for the keyword store, reading the keywords waits until the test lets it finish"""
+    def __init__(self, version: int):
+        self.version = version
+        self.release = threading.Event()
+
+    def get_keyword_version(self) -> int:
+        return self.version
+
+    def get_keyword_snapshot(self) -> tuple:
+        assert self.release.wait(5.0)
+        return self.version, []
+
+
+def request_snapshot(category_server, worker, worker_version=None) -> list:
+    """Sends a snapshot request as a worker's loader socket and lets the server handle it"""
+    worker.send_multipart([b"SNAPSHOT"] if worker_version is None else [b"SNAPSHOT", str(worker_version).encode()])
+    assert category_server._backend.poll(2000)
+    category_server.process_worker_messages()
+    return worker.recv_multipart() if worker.poll(200) else None
+
+
+def finish_snapshot_build(category_server):
+    """Waits for the snapshot thread and lets the loop swap its snapshot in"""
+    category_server._snapshot_build.result(5.0)
+    category_server.check_snapshot_build()
+
+
+def test_snapshot_is_rebuilt_off_the_loop(server):
+    category_server, client = server
+    database = category_server._database = SlowDatabase(1)
+    worker = category_server._context.socket(zmq.DEALER)
+    worker.setsockopt(zmq.LINGER, 0)
+    worker.connect(category_server._backend.getsockopt(zmq.LAST_ENDPOINT).decode())
+    try:
+        # the first request waits for the first snapshot without holding up the loop
+        assert request_snapshot(category_server, worker) is None
+        database.release.set()
+        finish_snapshot_build(category_server)
+        assert worker.poll(2000)
+        reply = worker.recv_multipart()
+        assert reply[:2] == [b"SNAPSHOT", b"1"] and len(reply) == 3
+
+        # while version 2 is rebuilt the version 1 snapshot is still served
+        database.version = 2
+        database.release.clear()
+        reply = request_snapshot(category_server, worker, 0)
+        assert reply[:2] == [b"SNAPSHOT", b"1"] and len(reply) == 3
+        assert request_snapshot(category_server, worker, 1) == [b"SNAPSHOT", b"1"]
+
+        database.release.set()
+        finish_snapshot_build(category_server)
+        reply = request_snapshot(category_server, worker, 1)
+        assert reply[:2] == [b"SNAPSHOT", b"2"] and len(reply) == 3
+    finally:
+        worker.close()
@@ -0,0 +1,96 @@
+import json
+import re
+import struct
+
+# msgpack is optional, JSON is always available and stays the default
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# the key every task object in a JSON task list has, quotes inside task text are escaped so
+# they never match
+TASK_KEY_PATTERN = re.compile(rb'"task"\s*:')
+# the start of a JSON chunk, an empty list, the opening of a list or any other value
+JSON_START_PATTERN = re.compile(rb"\s*(\[\s*\]|\[|\S)?")
+
+
+def available_encodings() -> list:
+    """Returns the encodings this process can read and write"""
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def detect_encoding(data) -> str:
+    """
+    Works out how a message was encoded.  JSON messages are objects or arrays so they start
+    with a brace or bracket, anything else is treated as msgpack.
+    :param data: the encoded message
+    :return: the encoding name
+    """
+    text = bytes(data[:16]).lstrip()
+    if text[:1] in (b"{", b"["):
+        return JSON
+    return MSGPACK
+
+
+def encode(message, encoding: str = JSON) -> bytes:
+    """
+    Encodes a message.
+    :param message: a JSON compatible message
+    :param encoding: json or msgpack
+    :return: the encoded message
+    """
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack encoding requested but msgpack is not installed")
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message).encode('utf-8')
+
+
+def decode(data, encoding: str = None):
+    """
+    Decodes a message.
+    :param data: the encoded message, bytes or a buffer
+    :param encoding: json or msgpack, detected from the data if not provided
+    :return: the decoded message
+    """
+    if encoding is None:
+        encoding = detect_encoding(data)
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack encoding received but msgpack is not installed")
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(bytes(data))
+
+
+def count_tasks(data, encoding: str) -> int:
+    """
+    Counts the tasks in an encoded chunk without decoding it.  msgpack lists carry their
+    length in the first bytes and JSON lists are counted by their task keys.  Workers
+    categorize any other non-empty chunk as a single task, so it counts as one.
+    :param data: the encoded chunk, bytes or a buffer
+    :param encoding: json or msgpack
+    :return: the number of tasks, 0 only for an empty chunk or an empty list
+    """
+    data = memoryview(data)
+    if encoding == MSGPACK:
+        if not data:
+            return 0
+        first = data[0]
+        if 0x90 <= first <= 0x9f:  # fixarray
+            return first & 0x0f
+        if first == 0xdc and len(data) >= 3:  # array 16
+            return struct.unpack_from(">H", data, 1)[0]
+        if first == 0xdd and len(data) >= 5:  # array 32
+            return struct.unpack_from(">I", data, 1)[0]
+        return 1
+
+    start = JSON_START_PATTERN.match(data).group(1)
+    if start is None or start.startswith(b"[") and start.endswith(b"]"):
+        return 0
+    if start != b"[":
+        return 1
+    return max(1, sum(1 for _ in TASK_KEY_PATTERN.finditer(data)))
@@ -0,0 +1,221 @@
+import argparse
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zmq
+from category_worker import CategoryWorker
+from keyword_index import KeywordIndex
+from keyword_snapshot import load_snapshot, fetch_snapshot
+from task_categorizer import TaskCategorization
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(host: str, port: int, keyword_index: KeywordIndex, cache_size: int, cache_path: str,
+               scoring: str, keyword_source: str):
+    """
+    Entry point of a pool child process.  Runs a worker on the keyword index that was
+    loaded by the pool before the fork.
+    """
+    if keyword_source == "database":
+        # the parent's pooled database connections must not be shared with the child
+        from task_category_db import engine
+        engine.dispose(close=False)
+    worker = CategoryWorker(host=host, port=port, keyword_index=keyword_index,
+                            cache_size=cache_size, cache_path=cache_path, scoring=scoring,
+                            keyword_source=keyword_source)
+    worker.process_tasks()
+
+
+class WorkerPool:
+    """
+    Represents a pool of worker processes.  The keyword index and NLTK state are loaded
+    once in the parent and shared copy-on-write with every forked worker.  Crashed workers
+    are restarted and the pool grows or shrinks with the server's backend queue depth.
+    """
+    def __init__(self, host="localhost", port=8889, min_workers=1, max_workers=None,
+                 scale_up_depth=4, scale_down_idle=30.0, check_interval=1.0,
+                 cache_size=10000, cache_path=None, scoring="python", keyword_source="server",
+                 snapshot_path=None):
+        self._host = host
+        self._port = port
+        self._cache_size = cache_size
+        self._cache_path = cache_path
+        self._scoring = scoring
+        self._keyword_source = keyword_source
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._min_workers = max(1, min(min_workers, self._max_workers))
+
+        # queued chunks per worker that triggers adding a worker
+        self._scale_up_depth = scale_up_depth
+        # seconds the queue must be empty before a worker is removed
+        self._scale_down_idle = scale_down_idle
+        self._check_interval = check_interval
+
+        self._queue_depth = 0
+        self._idle_since = time.monotonic()
+        self._workers = []
+        self._running = True
+
+        # fork shares the pre-loaded state, other platforms fall back to spawn
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._mp_context = multiprocessing.get_context("fork")
+        else:
+            self._mp_context = multiprocessing.get_context("spawn")
+
+        # loads the shared state once before any worker is started
+        self._keyword_index = self.load_keywords(snapshot_path)
+        TaskCategorization.categorize_batch(["warm up the lemmatizer"], self._keyword_index)
+        logger.info("Pool loaded %d keywords", len(self._keyword_index))
+
+        # moves the loaded objects out of the collector so children do not copy their pages
+        gc.freeze()
+
+        # for handling pool shutdown
+        signal.signal(signal.SIGINT, self.close)
+        signal.signal(signal.SIGTERM, self.close)
+        # profiling every worker at once with one signal to the pool
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.profile_workers)
+
+    def load_keywords(self, snapshot_path=None) -> KeywordIndex:
+        """Loads the keyword index from a snapshot file, the database or the server"""
+        if snapshot_path is not None:
+            return load_snapshot(snapshot_path)
+        if self._keyword_source == "database":
+            return KeywordIndex.from_database()
+
+        # the context is closed again so no ZeroMQ state is inherited by the forked workers
+        context = zmq.Context()
+        try:
+            while True:
+                try:
+                    return fetch_snapshot(context, self._host, self._port)
+                except TimeoutError as e:
+                    logger.warning("%s, still waiting", e)
+        finally:
+            context.term()
+
+    def start_worker(self):
+        """Starts a new worker process"""
+        process = self._mp_context.Process(target=run_worker,
+                                           args=(self._host, self._port, self._keyword_index,
+                                                 self._cache_size, self._cache_path, self._scoring,
+                                                 self._keyword_source),
+                                           daemon=True)
+        process.start()
+        self._workers.append(process)
+        logger.info("Pool started worker %d (%d running)", process.pid, len(self._workers))
+
+    def stop_worker(self):
+        """Stops the most recently started worker process"""
+        process = self._workers.pop()
+        process.terminate()
+        process.join(timeout=5)
+        logger.info("Pool stopped worker %d (%d running)", process.pid, len(self._workers))
+
+    def restart_crashed(self):
+        """Replaces any worker process that has exited"""
+        for process in list(self._workers):
+            if not process.is_alive():
+                logger.warning("Worker %d exited with code %s, restarting", process.pid, process.exitcode)
+                self._workers.remove(process)
+                self.start_worker()
+
+    def scale(self):
+        """Adds or removes a worker based on the last published backend queue depth"""
+        now = time.monotonic()
+        if self._queue_depth > 0:
+            self._idle_since = now
+
+        if (self._queue_depth > self._scale_up_depth * len(self._workers)
+                and len(self._workers) < self._max_workers):
+            self.start_worker()
+        elif (now - self._idle_since >= self._scale_down_idle
+                and len(self._workers) > self._min_workers):
+            self.stop_worker()
+            self._idle_since = now
+
+    def run(self, workers=None):
+        """
+        Starts the workers and supervises them until the pool is closed.
+        :param workers: number of workers to start with, defaults to the CPU count
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(self._min_workers, min(workers, self._max_workers))
+        for _ in range(workers):
+            self.start_worker()
+
+        # listens to the server's load updates after the workers are forked
+        context = zmq.Context()
+        load_socket = context.socket(zmq.SUB)
+        load_socket.connect(f"tcp://{self._host}:{self._port + 1}")
+        load_socket.setsockopt(zmq.SUBSCRIBE, b"load")
+        poller = zmq.Poller()
+        poller.register(load_socket, zmq.POLLIN)
+
+        try:
+            while self._running:
+                sockets = dict(poller.poll(int(self._check_interval * 1000)))
+                if sockets.get(load_socket) == zmq.POLLIN:
+                    topic, load = load_socket.recv_multipart()
+                    self._queue_depth = json.loads(load.decode('utf-8'))["queued_chunks"]
+
+                self.restart_crashed()
+                self.scale()
+        finally:
+            load_socket.close()
+            context.term()
+            while self._workers:
+                self.stop_worker()
+            logger.info("Pool closed")
+
+    def profile_workers(self, signalnum, frame):
+        """Passes a profiling signal on to every worker process"""
+        for process in self._workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def close(self, signalnum, frame):
+        """Handles stopping the pool"""
+        self._running = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a pool of task categorizer workers")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8889)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of workers to start with, defaults to the CPU count")
+    parser.add_argument("--min-workers", type=int, default=1)
+    parser.add_argument("--max-workers", type=int, default=None,
+                        help="defaults to the CPU count")
+    parser.add_argument("--scale-up-depth", type=int, default=4,
+                        help="queued chunks per worker that adds a worker")
+    parser.add_argument("--scale-down-idle", type=float, default=30.0,
+                        help="seconds of empty queue before a worker is removed")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="number of task categories each worker keeps in memory")
+    parser.add_argument("--cache-path", default=None,
+                        help="SQLite file for a cache that survives restarts")
+    parser.add_argument("--scoring", choices=["python", "sparse"], default="python",
+                        help="sparse scores each chunk with numpy/scipy matrices")
+    parser.add_argument("--keywords", choices=["server", "database"], default="server",
+                        help="load keywords from the server's snapshot or the local database")
+    parser.add_argument("--snapshot", default=None,
+                        help="snapshot file to load the keywords from at startup")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every message")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    pool = WorkerPool(host=args.host, port=args.port, min_workers=args.min_workers,
+                      max_workers=args.max_workers, scale_up_depth=args.scale_up_depth,
+                      scale_down_idle=args.scale_down_idle, cache_size=args.cache_size,
+                      cache_path=args.cache_path, scoring=args.scoring, keyword_source=args.keywords,
+                      snapshot_path=args.snapshot)
+    pool.run(args.workers)
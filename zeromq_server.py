@@ -1,168 +1,946 @@
-from datetime import datetime
+import argparse
+import logging
+import os
+import socket
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 import zmq
 import json
 import signal
-from task_category_db import TaskCategoryDatabase
+from task_category_db import TaskCategoryDatabase, migrate_schema
+from categories import Categories
+from feedback_writer import FeedbackWriter
+from keyword_index import KeywordIndex
+from keyword_snapshot import encode_snapshot
+from instrumentation import metrics
+from profiling import Profiler
+from result_cache import normalize_task
+from wire_format import JSON, available_encodings, count_tasks, detect_encoding, encode, decode
+
+logger = logging.getLogger(__name__)
+
+
+class PendingRequest:
+    """
+    Represents a client request whose chunks are still being categorized.  Streaming requests
+    forward each chunk as it arrives so only the chunk flags are kept.  Pass-through requests
+    keep the worker's encoded chunk frames and send them on without decoding them.  Coalesced
+    requests keep their tasks and are filled in one category at a time, since their unique
+    texts may be categorized in chunks shared with other requests.
+    """
+    def __init__(self, client_id: bytes, num_chunks: int, num_tasks=0, stream=False, client_request_id=None,
+                 encoding=JSON, passthrough=False, request_id=None, tasks=None, priority=False):
+        self.client_id = client_id
+        self.request_id = request_id
+        # small requests are dispatched from the priority lane ahead of bulk requests
+        self.priority = priority
+        self.stream = stream
+        self.encoding = encoding
+        self.passthrough = passthrough
+        self.client_request_id = client_request_id
+        self.num_tasks = num_tasks
+        self.chunks = None if stream else [None] * num_chunks
+        self.received = [False] * num_chunks
+        self.remaining = num_chunks
+        self.received_at = time.perf_counter()
+
+        # the original tasks and their categories for coalesced requests
+        self.tasks = tasks
+        self.categories = None
+        if tasks is not None:
+            self.categories = [None] * len(tasks)
+            self.remaining = len(tasks)
+
+    def add_chunk(self, chunk_no: int, tasks) -> bool:
+        """
+        Records the categorized tasks for a chunk.
+        :param chunk_no: the position of the chunk in the request
+        :param tasks: the categorized tasks returned by the worker, kept unless streaming
+        :return: True if the chunk had not been received before
+        """
+        if self.received[chunk_no]:
+            return False
+        self.received[chunk_no] = True
+        self.remaining -= 1
+        if not self.stream:
+            self.chunks[chunk_no] = tasks
+        return True
+
+    def set_category(self, positions: list, category: str):
+        """
+        Records the category of one unique task text for every task that has it.
+        :param positions: the positions of the tasks in the request
+        :param category: the category the worker chose
+        """
+        for pos in positions:
+            self.categories[pos] = category
+        self.remaining -= len(positions)
+
+    def is_complete(self) -> bool:
+        """Returns True once every chunk has been received"""
+        return self.remaining == 0
+
+    def get_response(self) -> dict:
+        """Creates the client response with the tasks in their original order"""
+        if self.tasks is not None:
+            tasks = [{"task_id": task["task_id"], "task": task["task"], "category": category}
+                     for task, category in zip(self.tasks, self.categories)]
+        else:
+            tasks = [task for chunk in self.chunks for task in chunk]
+        return {
+            "message type": "response",
+            "tasks": tasks
+        }
+
+    def get_passthrough_response(self) -> list:
+        """Creates the frames of a pass-through response, a header followed by each chunk in order"""
+        header = {"message type": "response", "chunks": len(self.chunks), "tasks": self.num_tasks}
+        return [encode(header, self.encoding)] + self.chunks
+
+    def get_partial(self, chunk_no: int, tasks) -> list:
+        """
+        Creates the frames of a streamed chunk message around the worker's encoded tasks
+        without decoding them.  Single frame JSON requests get a single JSON message, other
+        requests get a header frame followed by the worker's frame.
+        :param chunk_no: the position of the chunk in the request
+        :param tasks: the encoded categorized tasks from the worker
+        :return: the frames of the partial message
+        """
+        header = {"message type": "partial", "request_id": self.client_request_id, "chunk": chunk_no}
+        if self.encoding == JSON and not self.passthrough:
+            return [json.dumps(header)[:-1].encode() + b', "tasks": ' + tasks.bytes + b'}']
+        return [encode(header, self.encoding), tasks]
+
+    def get_end(self) -> dict:
+        """Creates the end of stream message with the request's counts"""
+        return {
+            "message type": "end",
+            "request_id": self.client_request_id,
+            "chunks": len(self.received),
+            "tasks": self.num_tasks
+        }
+
+
+class WorkerState:
+    """Represents a connected worker and the chunks it is working on"""
+    def __init__(self, worker_id: bytes, capacity: int):
+        self.worker_id = worker_id
+        self.capacity = max(1, capacity)
+        self.in_flight = set()
+        self.last_seen = time.monotonic()
+        # moving average of seconds per chunk, None until the first result
+        self.latency = None
+
+    def has_credit(self) -> bool:
+        """Returns True if the worker can take another chunk"""
+        return len(self.in_flight) < self.capacity
+
+    def record_latency(self, seconds: float, weight=0.2):
+        """Updates the moving average latency with a finished chunk"""
+        self.latency = seconds if self.latency is None else (1 - weight) * self.latency + weight * seconds
 
 
 class CategoryServer:
-    def __init__(self, host="localhost", port=8888):
+    def __init__(self, host="localhost", port=8888, chunk_size=50, heartbeat_interval=1.0,
+                 heartbeat_liveness=5, task_timeout=10.0, max_request_tasks=10000, max_client_tasks=20000,
+                 max_in_flight_tasks=100000, priority_tasks=None, hwm=1000, retry_after=1.0):
+        # number of tasks sent to a worker in one message
+        self._chunk_size = max(1, chunk_size)
+
+        # admission limits, requests over them are answered straight away with a busy message
+        self._max_request_tasks = max_request_tasks
+        self._max_client_tasks = max_client_tasks
+        self._max_in_flight_tasks = max_in_flight_tasks
+        # shortest retry delay suggested to a busy client (seconds)
+        self._retry_after = retry_after
+        # tasks of admitted requests that have not been answered, per client and in total
+        self._client_tasks = {}
+        self._in_flight_tasks = 0
+
+        # workers that announced themselves keyed by their ROUTER id
+        self._workers = {}
+        # chunks waiting for a worker with credit as
+        # (client id, request id, chunk no, encoding, payload, queued at)
+        self._task_queue = deque()
+        # chunks of requests with at most priority_tasks tasks, dispatched before the bulk queue
+        self._priority_tasks = self._chunk_size if priority_tasks is None else priority_tasks
+        self._priority_queue = deque()
+        # chunks sent to a worker keyed by (client id, request id, chunk no) as [chunk, sent at, worker id]
+        self._outstanding = {}
+
+        # a worker is dead after heartbeat_interval * heartbeat_liveness seconds of silence
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_liveness = heartbeat_liveness
+        # seconds before a chunk that has not come back is sent to another worker
+        self._task_timeout = task_timeout
+
+        # requests waiting on workers keyed by (client id, request id)
+        self._in_flight = {}
+        # (priority lane, normalized task text) being categorized -> [(pending request, task positions)]
+        # waiting on it, the lanes are kept apart so small requests never wait on a bulk chunk
+        self._coalesced = {}
+        # chunks of unique texts keyed like the outstanding chunks as ([coalesced keys], queued at)
+        self._chunk_texts = {}
+        self._next_request_id = 0
+
+        # how often the backend queue depth is published for the worker pool (seconds)
+        self._load_interval = 1.0
+        self._last_load_publish = 0.0
+        # how long the loop waits for messages before doing its periodic work (milliseconds)
+        self._poll_timeout = 50
+
+        # feedback writes rely on the unique indexes, so databases from older versions are
+        # deduplicated and indexed before anything is written
+        migrate_schema()
+        # feedback is acknowledged straight away and written in batches in the background
         self._database = TaskCategoryDatabase()
+        self._feedback_writer = FeedbackWriter(self._database)
+        self._feedback_writer.start()
+        # the keywords preprocessed once for every worker, kept current with the published updates.
+        # Only the snapshot thread touches the index, so a rebuild from the database never stalls the loop
+        self._keyword_index = None
+        self._snapshot_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+        # the encoded keyword snapshot sent to workers as (version, bytes), rebuilt when the version
+        # changes and served as it is until the rebuild finishes
+        self._snapshot = None
+        # the running rebuild, and (socket id, worker version) of snapshot requests made before the first one
+        self._snapshot_build = None
+        self._snapshot_waiting = []
         self._context = zmq.Context()
 
         # for connection with client program
         self._frontend = self._context.socket(zmq.ROUTER)
+        # bounds the messages queued per peer so slow clients or workers cannot grow memory
+        self._frontend.setsockopt(zmq.SNDHWM, hwm)
+        self._frontend.setsockopt(zmq.RCVHWM, hwm)
         self._frontend.bind(f"tcp://{host}:{port}")
-        print(f"Server listening on {host}:{port}....")
+        logger.info("Server listening on %s:%d....", host, port)
 
-        # for communicating with worker
-        self._backend = self._context.socket(zmq.DEALER)
+        # for communicating with workers, they announce when they have credit for more chunks
+        self._backend = self._context.socket(zmq.ROUTER)
+        self._backend.setsockopt(zmq.SNDHWM, hwm)
+        self._backend.setsockopt(zmq.RCVHWM, hwm)
         self._backend.bind(f"tcp://{host}:{port + 1}")  # 8889
-        print(f"Server listening on {host}:{port+1}....")
+        logger.info("Server listening on %s:%d....", host, port + 1)
+
+        # for publishing keyword updates to the workers and load to the worker pool
+        self._publisher = self._context.socket(zmq.PUB)
+        self._publisher.bind(f"tcp://{host}:{port + 2}")  # 8890
+        logger.info("Server publishing keyword updates on %s:%d....", host, port + 2)
+
+        # for reporting the server's timers and counters
+        self._stats_socket = self._context.socket(zmq.REP)
+        self._stats_socket.bind(f"tcp://{host}:{port + 3}")  # 8891
+        logger.info("Server stats available on %s:%d....", host, port + 3)
 
         # for closing sockets
         signal.signal(signal.SIGINT, self.close)
         signal.signal(signal.SIGTERM, self.close)
 
+        # profiles the event loop when TASK_CATEGORIZER_PROFILE is set or on SIGUSR1
+        self._profiler = Profiler("server", f"{socket.gethostname()}-{port}-{os.getpid()}")
+
         # for checking for messages
         self._poller = zmq.Poller()
         self._poller.register(self._frontend, zmq.POLLIN)
         self._poller.register(self._backend, zmq.POLLIN)
+        self._poller.register(self._stats_socket, zmq.POLLIN)
 
     def process_requests(self):
         """
         Method handles the main event loop of the server.  It receives messages from
         the client and checks the type and handles the forwarding of the message depending
-        on message t ype.
+        on message type.  Requests are not waited on, so worker responses for many clients
+        are collected in the same loop and each client is answered when its own tasks finish.
         """
         while True:
-            # checks ot see if there is a message from the client
-            sockets = dict(self._poller.poll())
+            # checks to see if there is a message from a client or a worker
+            sockets = dict(self._poller.poll(self._poll_timeout))
 
             if sockets.get(self._frontend) == zmq.POLLIN:
-                message = self._frontend.recv_multipart()
-                print(f"Received message: {message}")
-                client_id, message, request = self.partition_message(message)
-
-                # if the message is a request type it sends them to the worker and once
-                # it receives all responses it sends it to the client
-                if request:
-                    num_tasks = len(message["tasks"])
-                    self.distribute_tasks(client_id, message)
-                    response = self.get_responses(num_tasks)
-                    multipart_msg = [client_id, b'', json.dumps(response).encode()]
-                    print(f"Sending response: {multipart_msg} ")
-                    self._frontend.send_multipart(multipart_msg)
-                # if the message is a feedback type it adds it to the database and sends
-                # response to client
-                else:
-                    response = self.process_feedback(message)
-                    if response:
-                        multipart_msg = [client_id, b'', json.dumps(response).encode()]
-                        self._frontend.send_multipart(multipart_msg)
-
-    def partition_message(self, message) -> tuple[bytes, dict, bool]:
+                self.process_client_message()
+
+            if sockets.get(self._backend) == zmq.POLLIN:
+                self.process_worker_messages()
+
+            self.check_workers()
+            self.check_snapshot_build()
+            self.dispatch_tasks()
+
+            if sockets.get(self._stats_socket) == zmq.POLLIN:
+                self._stats_socket.recv()
+                self._stats_socket.send_json(self.get_stats())
+
+            self.publish_keywords()
+
+            if time.monotonic() - self._last_load_publish >= self._load_interval:
+                self.publish_load()
+
+            self._profiler.tick()
+
+    def process_client_message(self):
+        """
+        Receives a client message.  Requests are queued for the workers and recorded as in
+        flight, feedback is added to the database and answered straight away.
+        """
+        message = self._frontend.recv_multipart(copy=False)
+        client_id, message, request, encoding, chunk_frames = self.partition_message(message)
+        logger.debug("Received message: %s", message)
+
+        # if the message is a request type it queues them for the workers, the response is
+        # sent once all the chunks come back
+        if request:
+            request_id = str(self._next_request_id).encode()
+            self._next_request_id += 1
+
+            stream = bool(message.get("stream", False))
+            client_request_id = message.get("request_id")
+
+            # the request picks the encoding used for the workers and the response
+            encoding = message.get("encoding", encoding)
+            if encoding not in available_encodings():
+                encoding = JSON
+
+            # pass-through requests send pre-encoded chunks after the header, their tasks are
+            # counted from the frames so admission does not depend on the header
+            passthrough = bool(chunk_frames)
+            if passthrough:
+                num_tasks = sum(count_tasks(frame.buffer, encoding) for frame in chunk_frames)
+            else:
+                num_tasks = len(message["tasks"])
+            metrics.increment("requests")
+
+            # answers straight away when the request is malformed or would go over a limit
+            busy = self.check_task_count(message, num_tasks) if passthrough else None
+            if busy is None:
+                busy = self.check_admission(client_id, num_tasks)
+            if busy is not None:
+                metrics.increment("requests_rejected")
+                busy["request_id"] = client_request_id
+                self.send_response(client_id, busy, encoding)
+                return
+            metrics.increment("tasks", num_tasks)
+
+            priority = 0 < num_tasks <= self._priority_tasks
+            task_queue = self._priority_queue if priority else self._task_queue
+            if passthrough:
+                num_chunks = self.queue_chunk_frames(client_id, request_id, encoding, chunk_frames, task_queue)
+                pending = PendingRequest(client_id, num_chunks, num_tasks, stream, client_request_id,
+                                         encoding, passthrough, request_id, priority=priority)
+            elif stream:
+                num_chunks = self.distribute_tasks(client_id, request_id, message, encoding, task_queue)
+                pending = PendingRequest(client_id, num_chunks, num_tasks, stream, client_request_id,
+                                         encoding, passthrough, request_id, priority=priority)
+            else:
+                # buffered requests share the work for repeated task texts
+                pending = PendingRequest(client_id, 0, num_tasks, stream, client_request_id,
+                                         encoding, passthrough, request_id, message["tasks"], priority)
+                self.coalesce_tasks(pending)
+
+            if pending.is_complete():
+                self.send_response(client_id, pending.get_end() if stream else pending.get_response(), encoding)
+            else:
+                self._in_flight[(client_id, request_id)] = pending
+                self._client_tasks[client_id] = self._client_tasks.get(client_id, 0) + num_tasks
+                self._in_flight_tasks += num_tasks
+        # if the message is a feedback type it adds it to the database and sends
+        # response to client
+        else:
+            metrics.increment("feedback")
+            response = self.process_feedback(message)
+            if response:
+                self.send_response(client_id, response, encoding)
+
+    def process_worker_messages(self):
+        """
+        Receives every worker message that is ready.  Results are stored with their request and
+        requests that have all their chunks are sent back to the client.  Every message counts as
+        a heartbeat from the worker.
+        """
+        while True:
+            try:
+                message = self._backend.recv_multipart(zmq.NOBLOCK, copy=False)  # [worker_id, command, ...]
+            except zmq.Again:
+                return
+
+            worker_id, command = message[0].bytes, message[1].bytes
+            if command == b"SNAPSHOT":
+                # snapshot requests come from a worker's short-lived loader socket, not a worker
+                self.send_snapshot(worker_id, int(message[2].bytes) if len(message) > 2 else None)
+                continue
+            worker = self._workers.get(worker_id)
+
+            if command in (b"READY", b"HEARTBEAT"):
+                capacity = int(message[2].bytes) if len(message) > 2 else 1
+                if worker is None or command == b"READY":
+                    # a new or restarted worker starts with all of its credit
+                    if worker is not None:
+                        self.requeue_worker_chunks(worker)
+                    worker = self._workers[worker_id] = WorkerState(worker_id, capacity)
+                    logger.info("Worker %s ready with credit %d", worker_id.hex(), capacity)
+                # heartbeats carry the credit too, so a worker recreated from a result gets it back
+                worker.capacity = max(1, capacity)
+                worker.last_seen = time.monotonic()
+            elif command == b"RESULT":
+                if worker is None:
+                    worker = self._workers[worker_id] = WorkerState(worker_id, 1)
+                worker.last_seen = time.monotonic()
+                self.process_result(worker, message[2:])
+
+    def process_result(self, worker: WorkerState, message: list):
+        """
+        Stores a chunk result from a worker and returns the worker's credit.
+
+        :param worker: the worker that sent the result
+        :param message: [client_id, request_id, chunk_no, encoding, [tasks]] as frames
+        :return: None
+        """
+        client_id, request_id, chunk_no, encoding = [frame.bytes for frame in message[:4]]
+        tasks = message[4]
+        chunk_key = (client_id, request_id, chunk_no)
+
+        worker.in_flight.discard(chunk_key)
+        outstanding = self._outstanding.get(chunk_key)
+        if outstanding is not None and outstanding[2] == worker.worker_id:
+            del self._outstanding[chunk_key]
+            worker.record_latency(time.perf_counter() - outstanding[1])
+        elif outstanding is not None:
+            # the chunk was re-sent after a timeout but the first worker finished it
+            del self._outstanding[chunk_key]
+
+        # chunks of coalesced texts are fanned out to every request waiting on them
+        chunk_texts = self._chunk_texts.pop(chunk_key, None)
+        if chunk_texts is not None:
+            self.resolve_texts(chunk_texts, tasks, encoding.decode())
+            return
+
+        key = (client_id, request_id)
+        pending = self._in_flight.get(key)
+        if pending is None or pending.tasks is not None:
+            # a coalesced chunk that was already answered by another worker is a late duplicate
+            return
+
+        logger.debug("Received chunk %d of request %s from worker", int(chunk_no), request_id)
+        metrics.observe("chunk_round_trip", time.perf_counter() - pending.received_at)
+        if pending.stream:
+            # streamed chunks go straight to the client without being decoded
+            if pending.add_chunk(int(chunk_no), None):
+                self._frontend.send_multipart([client_id, b''] + pending.get_partial(int(chunk_no), tasks),
+                                              copy=False)
+        elif pending.passthrough:
+            pending.add_chunk(int(chunk_no), tasks)
+        else:
+            with metrics.timer(f"{pending.encoding}_decode"):
+                tasks = decode(tasks.buffer, encoding.decode())
+            pending.add_chunk(int(chunk_no), tasks)
+
+        if pending.is_complete():
+            self.finish_request(pending)
+
+    def resolve_texts(self, chunk_texts: tuple, tasks, encoding: str):
+        """
+        Fans the categories of a chunk of unique texts out to every request waiting on them.
+
+        :param chunk_texts: ([coalesced keys], queued at) for the chunk
+        :param tasks: the encoded categorized tasks from the worker, in the same order as the texts
+        :param encoding: the encoding of the worker's result
+        :return: None
+        """
+        keys, queued_at = chunk_texts
+        metrics.observe("chunk_round_trip", time.perf_counter() - queued_at)
+        with metrics.timer(f"{encoding}_decode"):
+            tasks = decode(tasks.buffer, encoding)
+
+        for key, task in zip(keys, tasks):
+            for pending, positions in self._coalesced.pop(key, ()):
+                pending.set_category(positions, task["category"])
+                if pending.is_complete():
+                    self.finish_request(pending)
+
+    def finish_request(self, pending: PendingRequest):
+        """Sends a request's response once every task is categorized and stops tracking it"""
+        self._in_flight.pop((pending.client_id, pending.request_id), None)
+        self.release_admission(pending.client_id, pending.num_tasks)
+        metrics.observe("request_latency", time.perf_counter() - pending.received_at)
+        logger.debug("All responses received for request %s", pending.request_id)
+        if pending.stream:
+            self.send_response(pending.client_id, pending.get_end(), pending.encoding)
+        elif pending.passthrough:
+            self._frontend.send_multipart([pending.client_id, b''] + pending.get_passthrough_response(), copy=False)
+        else:
+            self.send_response(pending.client_id, pending.get_response(), pending.encoding)
+
+    def check_task_count(self, message: dict, num_tasks: int) -> Union[dict, None]:
+        """
+        Checks the task count in a pass-through request header against the chunk frames.
+
+        :param message: the decoded request header
+        :param num_tasks: number of tasks counted in the chunk frames
+        :return: a busy message if the header is missing its count or it is wrong otherwise None
+        """
+        if message.get("task_count") != num_tasks:
+            # retrying will not help, the client has to send the right count
+            return {"message type": "busy", "reason": "task_count mismatch", "task_count": num_tasks}
+        return None
+
+    def check_admission(self, client_id: bytes, num_tasks: int) -> Union[dict, None]:
+        """
+        Checks a request against the request size and in flight limits.
+
+        :param client_id: A byte string of the client id
+        :param num_tasks: number of tasks in the request
+        :return: a busy message if the request is over a limit otherwise None
+        """
+        if num_tasks > self._max_request_tasks:
+            # retrying will not help, the client has to split the request
+            return {"message type": "busy", "reason": "too many tasks", "max_tasks": self._max_request_tasks}
+        if self._client_tasks.get(client_id, 0) + num_tasks > self._max_client_tasks:
+            return {"message type": "busy", "reason": "client limit", "retry_after": self.estimate_retry_after()}
+        if self._in_flight_tasks + num_tasks > self._max_in_flight_tasks:
+            return {"message type": "busy", "reason": "server limit", "retry_after": self.estimate_retry_after()}
+        return None
+
+    def release_admission(self, client_id: bytes, num_tasks: int):
+        """Returns a finished request's tasks to the client and global in flight limits"""
+        self._in_flight_tasks -= num_tasks
+        remaining = self._client_tasks.get(client_id, 0) - num_tasks
+        if remaining > 0:
+            self._client_tasks[client_id] = remaining
+        else:
+            self._client_tasks.pop(client_id, None)
+
+    def estimate_retry_after(self) -> float:
+        """Estimates how many seconds the workers need to work through the queued chunks"""
+        latencies = [worker.latency for worker in self._workers.values() if worker.latency is not None]
+        if not latencies:
+            return self._retry_after
+        capacity = sum(worker.capacity for worker in self._workers.values())
+        queued = len(self._priority_queue) + len(self._task_queue) + len(self._outstanding)
+        estimate = queued * (sum(latencies) / len(latencies)) / max(1, capacity)
+        return round(max(self._retry_after, estimate), 3)
+
+    def get_task_queue(self, client_id: bytes, request_id: bytes) -> deque:
+        """Returns the lane a request's chunks are queued in"""
+        pending = self._in_flight.get((client_id, request_id))
+        return self._priority_queue if pending is not None and pending.priority else self._task_queue
+
+    def dispatch_tasks(self):
+        """
+        Sends queued chunks to workers that have credit, favouring the workers with the
+        lowest observed latency.  The priority lane is emptied before the bulk queue.
+
+        :return: None
+        """
+        while self._priority_queue or self._task_queue:
+            idle = [worker for worker in self._workers.values() if worker.has_credit()]
+            if not idle:
+                return
+            # workers without a measurement yet are tried first so they get one
+            worker = min(idle, key=lambda state: (state.latency or 0.0, len(state.in_flight)))
+
+            chunk = (self._priority_queue or self._task_queue).popleft()
+            client_id, request_id, chunk_no, encoding, payload, queued_at = chunk
+            chunk_key = (client_id, request_id, chunk_no)
+            # skips chunks whose request is done or that came back after being re-queued
+            if not self.is_chunk_needed(chunk_key):
+                continue
+
+            metrics.observe("queue_wait", time.perf_counter() - queued_at)
+            self._backend.send_multipart([worker.worker_id, b"TASK", client_id, request_id, chunk_no, encoding,
+                                          payload], copy=False)
+            worker.in_flight.add(chunk_key)
+            self._outstanding[chunk_key] = [chunk, time.perf_counter(), worker.worker_id]
+
+    def is_chunk_needed(self, chunk_key: tuple) -> bool:
+        """Returns True if a queued chunk has not been answered yet"""
+        if chunk_key in self._chunk_texts:
+            return True
+        client_id, request_id, chunk_no = chunk_key
+        pending = self._in_flight.get((client_id, request_id))
+        return pending is not None and pending.tasks is None and not pending.received[int(chunk_no)]
+
+    def send_snapshot(self, socket_id: bytes, worker_version: int = None):
+        """
+        Sends the current keyword snapshot to a worker that asked for it.  When the keyword
+        store version has changed the snapshot is rebuilt on the snapshot thread and the previous
+        one is sent until the rebuild finishes, requests made before the first snapshot is built
+        are answered once it is.
+        :param socket_id: the ROUTER id of the socket that asked
+        :param worker_version: the version the worker already has, if it sent one
+        :return: None
+        """
+        version = self._database.get_keyword_version()
+        if worker_version == version:
+            # the worker is up to date so only the version is sent back
+            self._backend.send_multipart([socket_id, b"SNAPSHOT", str(version).encode()])
+            return
+        if self._snapshot is None or self._snapshot[0] != version:
+            self.start_snapshot_build()
+        if self._snapshot is None:
+            self._snapshot_waiting.append((socket_id, worker_version))
+            return
+        self.send_cached_snapshot(socket_id, worker_version)
+
+    def send_cached_snapshot(self, socket_id: bytes, worker_version: int = None):
+        """
+        Sends the last snapshot that was built, or only its version if the worker already has it.
+        :param socket_id: the ROUTER id of the socket that asked
+        :param worker_version: the version the worker already has, if it sent one
+        :return: None
+        """
+        version, snapshot = self._snapshot
+        if worker_version == version:
+            self._backend.send_multipart([socket_id, b"SNAPSHOT", str(version).encode()])
+            return
+        metrics.increment("snapshots_sent")
+        self._backend.send_multipart([socket_id, b"SNAPSHOT", str(version).encode(), snapshot])
+        logger.info("Sent keyword snapshot version %d (%d bytes)", version, len(snapshot))
+
+    def start_snapshot_build(self):
+        """Starts rebuilding the snapshot on the snapshot thread unless a rebuild is already running"""
+        if self._snapshot_build is None:
+            self._snapshot_build = self._snapshot_builder.submit(self.build_snapshot)
+
+    def check_snapshot_build(self):
+        """
+        Swaps in a finished snapshot and answers the workers that were waiting for one.  A failed
+        rebuild is logged and tried again on the next snapshot request.
+        :return: None
+        """
+        if self._snapshot_build is None or not self._snapshot_build.done():
+            return
+        build, self._snapshot_build = self._snapshot_build, None
+        try:
+            self._snapshot = build.result()
+        except Exception as e:
+            metrics.increment("snapshot_errors")
+            logger.error("Error building the keyword snapshot: %s", e)
+
+        waiting, self._snapshot_waiting = self._snapshot_waiting, []
+        if self._snapshot is None:
+            # the workers keep asking until they get an answer, so their next request retries
+            return
+        for socket_id, worker_version in waiting:
+            self.send_cached_snapshot(socket_id, worker_version)
+
+    def build_snapshot(self) -> tuple:
+        """
+        Encodes the keyword index, the keywords are only re-read from the database when the
+        published updates do not account for the keyword store version.  Runs on the snapshot thread.
+        :return: the snapshot as (version, bytes)
+        """
+        version = self._database.get_keyword_version()
+        if self._keyword_index is None or self._keyword_index.version != version:
+            with metrics.timer("snapshot_load"):
+                self._keyword_index = KeywordIndex.from_database(self._database)
+        with metrics.timer("snapshot_encode"):
+            return self._keyword_index.version, encode_snapshot(self._keyword_index)
+
+    def apply_keyword_update(self, version: int, links: list):
+        """
+        Applies a published keyword update to the index, a gap reloads the index on the next
+        rebuild.  Runs on the snapshot thread.
+        :return: None
+        """
+        if self._keyword_index is not None and not self._keyword_index.apply_delta(version, links):
+            self._keyword_index = None
+
+    def check_workers(self):
+        """
+        Removes workers that have stopped sending heartbeats and re-queues chunks that have
+        been out longer than the task timeout.
+
+        :return: None
+        """
+        now = time.monotonic()
+        expiry = self._heartbeat_interval * self._heartbeat_liveness
+        for worker_id, worker in list(self._workers.items()):
+            if now - worker.last_seen > expiry:
+                logger.warning("Worker %s missed its heartbeats, removing it", worker_id.hex())
+                metrics.increment("workers_expired")
+                del self._workers[worker_id]
+                self.requeue_worker_chunks(worker)
+
+        deadline = time.perf_counter() - self._task_timeout
+        for chunk_key, outstanding in list(self._outstanding.items()):
+            if outstanding[1] < deadline:
+                logger.warning("Chunk %s timed out, sending it to another worker", chunk_key)
+                metrics.increment("chunks_timed_out")
+                del self._outstanding[chunk_key]
+                self.get_task_queue(*chunk_key[:2]).appendleft(outstanding[0])
+
+    def requeue_worker_chunks(self, worker: WorkerState):
+        """Puts the chunks a worker had not finished back at the front of the queue"""
+        for chunk_key in worker.in_flight:
+            outstanding = self._outstanding.get(chunk_key)
+            if outstanding is not None and outstanding[2] == worker.worker_id:
+                del self._outstanding[chunk_key]
+                self.get_task_queue(*chunk_key[:2]).appendleft(outstanding[0])
+        worker.in_flight.clear()
+
+    def send_response(self, client_id: bytes, response: dict, encoding=JSON):
+        """
+        Sends a response message to a client.
+
+        :param client_id: A byte string of the client id
+        :param response: the response dictionary
+        :param encoding: the encoding the client asked for
+        :return: None
+        """
+        with metrics.timer(f"{encoding}_encode"):
+            multipart_msg = [client_id, b'', encode(response, encoding)]
+        logger.debug("Sending response: %s", multipart_msg)
+        self._frontend.send_multipart(multipart_msg)
+
+    def partition_message(self, message) -> tuple[bytes, dict, bool, str, list]:
         """
         Method receives a multipart message and breaks it into its component segments
-        and also determines the message type.
+        and also determines the message type and encoding.
 
-        :param message: a multipart message consisting of byte strings
-        :return: Tuple containing the client id, the decoded message and a boolean val for
-        message type
+        :param message: a multipart message of frames
+        :return: Tuple containing the client id, the decoded message, a boolean val for
+        message type, the message encoding and any pre-encoded chunk frames after the message
         """
         # get component parts
-        message_text = message[2].decode("utf-8")
-        client_id = message[0]  # 1 is empty byte string
+        client_id = message[0].bytes  # 1 is empty byte string
+        payload = message[2].buffer
 
-        # loads message
-        message_dict = json.loads(message_text)
+        # loads message in whichever encoding the client used
+        encoding = detect_encoding(payload)
+        with metrics.timer(f"{encoding}_decode"):
+            message_dict = decode(payload, encoding)
 
         # checks if its a request message
         request = message_dict.get("message type") == "request"
 
-        return client_id, message_dict, request
+        return client_id, message_dict, request, encoding, message[3:]
 
-    def distribute_tasks(self, client_id: bytes, message:dict):
+    def distribute_tasks(self, client_id: bytes, request_id: bytes, message:dict, encoding=JSON,
+                         task_queue: deque = None) -> int:
         """
-        Method receives a client id and message dictionary.  The dictionary has a list
-        of tasks.  Method distributes each task to the worker one by one.
+        Method receives a client id, request id and message dictionary.  The dictionary has
+        a list of tasks.  Method splits the tasks into chunks and queues each chunk for the
+        workers with its request id and chunk number so the responses can be matched to the
+        request and put back in order.
 
         :param client_id: A byte string of the client id
+        :param request_id: A byte string of the server assigned request id
         :param message: A dictionary version of the client's message
-        :return: None
+        :param encoding: the encoding used for the worker messages
+        :param task_queue: the lane to queue the chunks in, the bulk queue if not provided
+        :return: The number of chunks that were queued
         """
+        if task_queue is None:
+            task_queue = self._task_queue
         del message["message type"]  # removes the message type
         tasks = message["tasks"]    # flattens remaining tasks
 
-        task_no = 0
+        chunk_no = 0
+
+        # queues each chunk of tasks so 1 chunk == 1 worker message
+        queued_at = time.perf_counter()
+        encoding_frame = encoding.encode()
+        for start in range(0, len(tasks), self._chunk_size):
+            with metrics.timer(f"{encoding}_encode"):
+                encoded_chunk = encode(tasks[start:start + self._chunk_size], encoding)
+            logger.debug("Queueing chunk %d of request %s", chunk_no, request_id)
+            task_queue.append((client_id, request_id, str(chunk_no).encode(), encoding_frame,
+                               encoded_chunk, queued_at))
+            chunk_no += 1
 
-        # sends each task to the worker so 1 task == 1 message
-        while task_no < len(tasks):
-            json_task = json.dumps(tasks[task_no]).encode('utf-8')
-            print(f"sending task {tasks[task_no]} to worker {datetime.now()}")
-            self._backend.send_multipart([client_id, json_task])
-            task_no += 1
+        return chunk_no
 
-    def get_responses(self, total: int) -> dict:
+    def coalesce_tasks(self, pending: PendingRequest):
         """
-        Gathers all the responses from the worker and adds it to the client response.
+        Method queues the unique task texts of a request for the workers.  Tasks are matched
+        on their normalized text, so a text that repeats in the request or is already being
+        categorized for another request is only sent to a worker once.  The request waits on
+        every text and gets its categories when the chunk holding the text comes back.
 
-        :param total: the number of tasks that were sent
-        :return: A dictionary containing the response to the client
+        :param pending: the request with its tasks
+        :return: The number of chunks that were queued
         """
-        # checks if responses are ready
-        sockets = dict(self._poller.poll())
-        response = {
-            "message type": "response",
-            "tasks": []
-        }
-        responses = 0
+        # positions of each unique text in the request
+        positions = {}
+        for pos, task in enumerate(pending.tasks):
+            positions.setdefault(normalize_task(task["task"]), []).append(pos)
 
-        # loops until it receives all responses
-        while responses < total:
-            # if a worker response is ready it gets it and adds it to the client response
-            if sockets.get(self._backend) == zmq.POLLIN:
-                message = self._backend.recv_multipart()
-                new_task = json.loads(message[1])
-                print(f"Received response from worker: {new_task} {datetime.now()}")
-                response["tasks"].append(new_task)
-                responses += 1
-        print(f"all responses received {datetime.now()}")
-        return response
+        new_tasks = []
+        for text, text_positions in positions.items():
+            key = (pending.priority, text)
+            waiting = self._coalesced.get(key)
+            if waiting is None:
+                waiting = self._coalesced[key] = []
+                new_tasks.append((key, pending.tasks[text_positions[0]]))
+            waiting.append((pending, text_positions))
+        metrics.increment("tasks_coalesced", len(pending.tasks) - len(new_tasks))
+
+        # queues each chunk of new texts so 1 chunk == 1 worker message
+        task_queue = self._priority_queue if pending.priority else self._task_queue
+        queued_at = time.perf_counter()
+        encoding_frame = pending.encoding.encode()
+        chunk_no = 0
+        for start in range(0, len(new_tasks), self._chunk_size):
+            chunk = new_tasks[start:start + self._chunk_size]
+            with metrics.timer(f"{pending.encoding}_encode"):
+                encoded_chunk = encode([task for key, task in chunk], pending.encoding)
+            chunk_key = (pending.client_id, pending.request_id, str(chunk_no).encode())
+            self._chunk_texts[chunk_key] = ([key for key, task in chunk], queued_at)
+            logger.debug("Queueing chunk %d of request %s", chunk_no, pending.request_id)
+            task_queue.append(chunk_key + (encoding_frame, encoded_chunk, queued_at))
+            chunk_no += 1
+
+        return chunk_no
+
+    def queue_chunk_frames(self, client_id: bytes, request_id: bytes, encoding: str, chunk_frames: list,
+                           task_queue: deque = None) -> int:
+        """
+        Method queues a pass-through request's chunk frames for the workers without decoding
+        them.  Each frame is an encoded list of tasks and becomes one worker message.
+
+        :param client_id: A byte string of the client id
+        :param request_id: A byte string of the server assigned request id
+        :param encoding: the encoding of the chunk frames
+        :param chunk_frames: the pre-encoded chunks sent after the request header
+        :param task_queue: the lane to queue the chunks in, the bulk queue if not provided
+        :return: The number of chunks that were queued
+        """
+        if task_queue is None:
+            task_queue = self._task_queue
+        queued_at = time.perf_counter()
+        encoding_frame = encoding.encode()
+        for chunk_no, frame in enumerate(chunk_frames):
+            task_queue.append((client_id, request_id, str(chunk_no).encode(), encoding_frame,
+                               frame, queued_at))
+        return len(chunk_frames)
 
     def process_feedback(self, message) -> Union[dict, None]:
         """
-        Method receives a client message and adds the task to the correct category database
-        to improve future performance and creates the response.
+        Method receives a client message, queues the task to be added to the correct category
+        database to improve future performance and creates the response.
 
         :param message: the multipart message from client
-        :return: A response in dictionary format or None if error adding to the database
+        :return: A response in dictionary format or None if the task or category is not valid
         """
         task = message['feedback']['task']
         orig_category = message['feedback']['category_provided']
         new_category = message['feedback']['category_feedback']
 
+        if Categories.get_enum_from_display(new_category) is None:
+            return
+        # the writer lowercases and stores the task as a keyword, so it has to be text
+        if not isinstance(task, str) or not task.strip():
+            return
+
         response = {"message type": "response",
                     "message": f"Received feedback for task: {task}.  Category should be {new_category} "
                                f"instead of {orig_category}."
                     }
 
-        # calls database to add the keyword/category link
-        result = self._database.add_keyword_category(new_category, task)
-        if result:
-            print(f"Sending response: {response}")
-            return response
-        return
+        # the writer adds the keyword/category link in the background
+        if not self._feedback_writer.submit(new_category, task):
+            metrics.increment("feedback_rejected")
+            return {"message type": "busy", "reason": "feedback backlog", "retry_after": self._retry_after}
+        return response
+
+    def publish_keywords(self):
+        """
+        Publishes the keywords committed by the feedback writer to the workers so they can
+        update their keyword index without reloading it.
+
+        :return: None
+        """
+        while True:
+            try:
+                version, links = self._feedback_writer.committed.get_nowait()
+            except queue.Empty:
+                return
+            delta = {
+                "version": version,
+                "keywords": links
+            }
+            self._publisher.send_multipart([b"keyword", json.dumps(delta).encode()])
+            # only the new keywords are preprocessed, in order with any rebuild on the snapshot thread
+            self._snapshot_builder.submit(self.apply_keyword_update, version, links)
+
+    def publish_load(self):
+        """
+        Publishes how many chunks are waiting on workers so the worker pool can scale.
+
+        :return: None
+        """
+        load = {
+            "queued_chunks": len(self._priority_queue) + len(self._task_queue) + len(self._outstanding),
+            "in_flight_requests": len(self._in_flight),
+            "workers": len(self._workers)
+        }
+        self._publisher.send_multipart([b"load", json.dumps(load).encode()])
+        self._last_load_publish = time.monotonic()
+
+    def get_stats(self) -> dict:
+        """Returns the server's timers and counters along with its current load"""
+        stats = metrics.snapshot()
+        stats["in_flight_requests"] = len(self._in_flight)
+        stats["coalesced_texts"] = len(self._coalesced)
+        stats["queued_chunks"] = len(self._task_queue)
+        stats["priority_chunks"] = len(self._priority_queue)
+        stats["in_flight_tasks"] = self._in_flight_tasks
+        stats["outstanding_chunks"] = len(self._outstanding)
+        stats["workers"] = {worker.worker_id.hex(): {"in_flight": len(worker.in_flight),
+                                                     "capacity": worker.capacity,
+                                                     "latency_ms": (worker.latency or 0.0) * 1000}
+                            for worker in self._workers.values()}
+        return stats
 
     def close(self, signalnum, frame):
         """Handles closing of the socket """
+        self._profiler.close()
+        self._snapshot_builder.shutdown(wait=False, cancel_futures=True)
+        self._feedback_writer.close()
         self._frontend.close()
         self._backend.close()
+        self._publisher.close()
+        self._stats_socket.close()
         self._context.term()
-        print("Server Closed")
+        logger.info("Server Closed")
 
 
 if __name__ == "__main__":
-    server = CategoryServer()
+    parser = argparse.ArgumentParser(description="Runs the task categorizer server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--chunk-size", type=int, default=50,
+                        help="number of tasks sent to a worker in one message")
+    parser.add_argument("--heartbeat-interval", type=float, default=1.0,
+                        help="seconds between worker heartbeats")
+    parser.add_argument("--heartbeat-liveness", type=int, default=5,
+                        help="missed heartbeats before a worker is treated as dead")
+    parser.add_argument("--task-timeout", type=float, default=10.0,
+                        help="seconds before an unanswered chunk is sent to another worker")
+    parser.add_argument("--max-request-tasks", type=int, default=10000,
+                        help="largest request accepted, bigger requests get a busy message")
+    parser.add_argument("--max-client-tasks", type=int, default=20000,
+                        help="unanswered tasks allowed per client before it gets busy messages")
+    parser.add_argument("--max-in-flight-tasks", type=int, default=100000,
+                        help="unanswered tasks allowed in total before clients get busy messages")
+    parser.add_argument("--priority-tasks", type=int, default=None,
+                        help="requests with at most this many tasks use the priority lane, "
+                             "defaults to the chunk size")
+    parser.add_argument("--hwm", type=int, default=1000,
+                        help="high-water mark of the client and worker sockets")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="shortest retry delay suggested to busy clients (seconds)")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every message")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    server = CategoryServer(host=args.host, port=args.port, chunk_size=args.chunk_size,
+                            heartbeat_interval=args.heartbeat_interval,
+                            heartbeat_liveness=args.heartbeat_liveness, task_timeout=args.task_timeout,
+                            max_request_tasks=args.max_request_tasks, max_client_tasks=args.max_client_tasks,
+                            max_in_flight_tasks=args.max_in_flight_tasks, priority_tasks=args.priority_tasks,
+                            hwm=args.hwm, retry_after=args.retry_after)
     server.process_requests()
\ No newline at end of file